@@ -0,0 +1,40 @@
+import importlib
+
+# Library entry points of the tools, for callers that keep a process warm
+# and run batches back to back instead of spawning the scripts. Nothing here
+# prompts or exits; missing inputs raise instead. The tools live in the
+# 'tools' package next to this one, and each entry point is only imported on
+# first access so netCDF4, OpenCV and matplotlib are loaded by the stages
+# that use them and not by 'import geos_sat'.
+#
+#   import geos_sat
+#   geos_sat.download('data_sources/<order>.txt')
+#   images, skipped, errors = geos_sat.extract('data/<order>', ['C01', 'C02'], workers=4)
+
+# Public name -> (tool module, function)
+API = {
+    'download': ('get_data', 'download_source'),
+    'extract': ('extract_img_data', 'extract_directory'),
+    'extract_file': ('extract_img_data', 'extract_image'),
+    'crop': ('image_crop', 'crop_image_dirs'),
+    'crop_arrays': ('image_crop', 'crop_array_store'),
+    'render': ('render_animation', 'render_image_dirs'),
+    'render_arrays': ('render_animation', 'render_array_store'),
+    'composite': ('composite', 'composite_array_store'),
+    'read_region': ('tile_pyramid', 'read_region'),
+    'create_metrics': ('metrics', 'create_metrics'),
+}
+
+__all__ = sorted(API)
+
+def __getattr__(name):
+    if name not in API:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, function_name = API[name]
+    function = getattr(importlib.import_module(f'tools.{module_name}'), function_name)
+    # Cache it so later lookups don't go through __getattr__
+    globals()[name] = function
+    return function
+
+def __dir__():
+    return sorted(set(globals()) | set(API))
@@ -0,0 +1,6 @@
+# GOES-R download, extraction and rendering tools. Each module is a command
+# line tool run from the repository root, e.g.
+#
+#   python -m tools.get_data data_sources/<order>.txt
+#
+# and imports the modules it shares code with relative to this package.
@@ -0,0 +1,141 @@
+import os
+import json
+import contextlib
+import numpy as np
+from .goes_files import parse_goes_filename, format_goes_time
+
+# On-disk store of extracted CMI arrays, one float32 .npy file per frame laid
+# out as <root>/<channel>/<scan start>.npy. Masked pixels are stored as NaN.
+# Frames are opened memory-mapped, so reading a crop only touches the rows
+# it needs and no netCDF decoding or image codec is involved. The value range
+# of each frame's valid pixels is kept next to it in <scan start>.range.json,
+# so a crop can be rendered like the whole frame without scanning it.
+
+# Number of bytes of a frame scanned at a time when its range isn't stored
+RANGE_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Function to get the (min, max) of the finite values of 'data', or None if
+# there are none
+def finite_range(data):
+    finite = data[np.isfinite(data)]
+    if not finite.size:
+        return None
+    return float(finite.min()), float(finite.max())
+
+# Function to merge two ranges, either of which may be None
+def merge_ranges(a, b):
+    if a is None or b is None:
+        return a or b
+    return min(a[0], b[0]), max(a[1], b[1])
+
+class ArrayStore:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, channel, key):
+        return os.path.join(self.root, channel, f'{key}.npy')
+
+    def range_path(self, channel, key):
+        return os.path.join(self.root, channel, f'{key}.range.json')
+
+    # Replace a frame with its temporary file and store its value range. The
+    # old range is removed first, so a reader never pairs a frame with the
+    # range of another one.
+    def commit(self, channel, key, temp_path, value_range):
+        range_path = self.range_path(channel, key)
+        if os.path.exists(range_path):
+            os.remove(range_path)
+        os.replace(temp_path, self.path(channel, key))
+
+        vmin, vmax = value_range or (0.0, 0.0)
+        with open(f'{range_path}.tmp', 'w') as f:
+            json.dump({'vmin': vmin, 'vmax': vmax}, f)
+        os.replace(f'{range_path}.tmp', range_path)
+
+    def write(self, channel, key, data):
+        os.makedirs(os.path.join(self.root, channel), exist_ok=True)
+        array = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+
+        # Write to a temporary file first so readers never see a partial frame
+        path = self.path(channel, key)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        self.commit(channel, key, temp_path, finite_range(array))
+        return path
+
+    # Context manager to write a frame a strip of rows at a time, for frames
+    # too large to hold in memory. Yields a function taking the next rows;
+    # the frame only replaces an earlier one once every row is written.
+    @contextlib.contextmanager
+    def writer(self, channel, key, shape):
+        os.makedirs(os.path.join(self.root, channel), exist_ok=True)
+        path = self.path(channel, key)
+        temp_path = f'{path}.tmp'
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)), 'fortran_order': False, 'shape': tuple(shape)}
+        rows_written = 0
+        value_range = None
+
+        def write_rows(rows):
+            nonlocal rows_written, value_range
+            rows = np.ma.filled(np.ma.asarray(rows, dtype=np.float32), np.nan)
+            f.write(rows.tobytes())
+            value_range = merge_ranges(value_range, finite_range(rows))
+            rows_written += len(rows)
+
+        try:
+            with open(temp_path, 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, header)
+                yield write_rows
+            if rows_written != shape[0]:
+                raise ValueError(f"frame has {rows_written} of {shape[0]} rows")
+            self.commit(channel, key, temp_path, value_range)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def read(self, channel, key):
+        return np.load(self.path(channel, key), mmap_mode='r')
+
+    # Value range (vmin, vmax) of a frame's valid pixels, (0, 0) if it has
+    # none. Frames written before ranges were stored are scanned a block of
+    # rows at a time.
+    def value_range(self, channel, key, data=None):
+        try:
+            with open(self.range_path(channel, key)) as f:
+                stored = json.load(f)
+            return stored['vmin'], stored['vmax']
+        except FileNotFoundError:
+            pass
+
+        if data is None:
+            data = self.read(channel, key)
+        row_bytes = max(1, data[:1].nbytes)
+        block_rows = max(1, RANGE_BLOCK_BYTES // row_bytes)
+        value_range = None
+        for start in range(0, data.shape[0], block_rows):
+            value_range = merge_ranges(value_range, finite_range(data[start:start + block_rows]))
+        return value_range or (0.0, 0.0)
+
+    def channels(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+    def keys(self, channel):
+        channel_dir = os.path.join(self.root, channel)
+        if not os.path.isdir(channel_dir):
+            return []
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(channel_dir) if f.endswith('.npy'))
+
+    def items(self, channel):
+        for key in self.keys(channel):
+            yield key, self.read(channel, key)
+
+# Function to get the (channel, key) a netCDF file is stored under
+def store_key(nc_path):
+    goes_file = parse_goes_filename(nc_path)
+    if goes_file is None:
+        raise ValueError(f"'{os.path.basename(nc_path)}' doesn't follow the GOES-R naming convention")
+    return goes_file.channel or goes_file.product, format_goes_time(goes_file.start)
@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+from urllib.parse import urlsplit
+from tqdm import tqdm
+from .get_data import get_part_path
+from .metrics import FileMetrics, track
+
+READ_CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+THROTTLE_STATUSES = (429, 503)
+MAX_ATTEMPTS = 8
+
+# Concurrency limiter that adapts the number of in-flight requests.
+# Every 'window' seconds the observed throughput is compared with the previous
+# window: the limit grows by one while throughput keeps improving and shrinks
+# by one once adding requests stops paying off. A 429/503 response halves it.
+class AdaptiveLimiter:
+    def __init__(self, initial, minimum=1, maximum=64, window=5.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.window = window
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_saturated = False
+        self.last_throughput = 0.0
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self.window_saturated = True
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def set_limit(self, limit):
+        async with self.condition:
+            self.limit = max(self.minimum, min(limit, self.maximum))
+            self.condition.notify_all()
+
+    async def record_bytes(self, count):
+        self.window_bytes += count
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return
+
+        throughput = self.window_bytes / elapsed
+        if throughput > self.last_throughput * 1.05:
+            # Only probe upwards if the current limit was actually in use
+            if self.window_saturated:
+                await self.set_limit(self.limit + 1)
+        elif throughput < self.last_throughput * 0.9:
+            await self.set_limit(self.limit - 1)
+
+        self.last_throughput = throughput
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_saturated = self.in_flight >= self.limit
+
+    async def throttled(self):
+        await self.set_limit(self.limit // 2)
+        self.last_throughput = 0.0
+
+# Per-host byte counters, used to report throughput for each archive host
+class HostStats:
+    def __init__(self):
+        self.hosts = {}
+
+    def host(self, url):
+        now = time.monotonic()
+        return self.hosts.setdefault(urlsplit(url).netloc, {'bytes': 0, 'files': 0, 'throttled': 0, 'first': now, 'last': now})
+
+    def record(self, url, count):
+        stats = self.host(url)
+        stats['bytes'] += count
+        stats['last'] = time.monotonic()
+
+    def record_file(self, url):
+        self.host(url)['files'] += 1
+
+    def record_throttle(self, url):
+        self.host(url)['throttled'] += 1
+
+    def summary(self):
+        summary = {}
+        for host, stats in self.hosts.items():
+            elapsed = max(stats['last'] - stats['first'], 1e-6)
+            summary[host] = {
+                'bytes': stats['bytes'],
+                'files': stats['files'],
+                'throttled': stats['throttled'],
+                'seconds': elapsed,
+                'bytes_per_second': stats['bytes'] / elapsed,
+            }
+        return summary
+
+class ThrottledError(Exception):
+    def __init__(self, status, retry_after):
+        super().__init__(f"server responded {status}")
+        self.retry_after = retry_after
+
+def parse_retry_after(value, default):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+# Function to get the remote size and If-Range validator of a file
+async def get_remote_info(session, url):
+    async with session.head(url, allow_redirects=True) as response:
+        if response.status in THROTTLE_STATUSES:
+            raise ThrottledError(response.status, parse_retry_after(response.headers.get('Retry-After'), None))
+        if response.status >= 400:
+            return None, None
+
+        size = response.headers.get('Content-Length')
+        size = int(size) if size is not None else None
+
+        validator = response.headers.get('ETag')
+        if validator is None or validator.startswith('W/'):
+            validator = response.headers.get('Last-Modified')
+        return size, validator
+
+# Function to write a buffer to disk without blocking the event loop
+async def flush_buffer(f, buffer):
+    if buffer:
+        await asyncio.get_running_loop().run_in_executor(None, f.write, bytes(buffer))
+        buffer.clear()
+
+# Function to perform a single download attempt, resuming any .part file
+async def fetch_file(session, limiter, stats, url, save_path, pbar, manifest=None, record=None):
+    if record is None:
+        record = FileMetrics(os.path.basename(url))
+
+    with record.stage('network'):
+        total_size, validator = await get_remote_info(session, url)
+    if manifest is not None:
+        manifest.record_remote(os.path.basename(url), total_size, validator)
+
+    if total_size is not None and os.path.exists(save_path) and os.path.getsize(save_path) == total_size:
+        if manifest is not None:
+            manifest.mark_complete(os.path.basename(url), total_size, validator)
+        return False
+
+    part_path = get_part_path(save_path)
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if total_size is not None and resume_from > total_size:
+        resume_from = 0
+
+    if total_size is None or resume_from < total_size:
+        headers = {}
+        if resume_from:
+            headers['Range'] = f'bytes={resume_from}-'
+            if validator:
+                headers['If-Range'] = validator
+
+        network_start = time.perf_counter()
+        async with session.get(url, headers=headers) as response:
+            if response.status in THROTTLE_STATUSES:
+                raise ThrottledError(response.status, parse_retry_after(response.headers.get('Retry-After'), None))
+            response.raise_for_status()
+            if response.status != 206:
+                resume_from = 0
+                if total_size is None and response.content_length is not None:
+                    total_size = response.content_length
+
+            buffer = bytearray()
+            with open(part_path, 'ab' if resume_from else 'wb') as f:
+                async for data in response.content.iter_chunked(READ_CHUNK_SIZE):
+                    # Time waiting for this chunk, other downloads included
+                    record.add('network', time.perf_counter() - network_start, len(data))
+                    buffer += data
+                    if len(buffer) >= WRITE_BUFFER_SIZE:
+                        with record.stage('write', len(buffer)):
+                            await flush_buffer(f, buffer)
+                    stats.record(url, len(data))
+                    pbar.update(len(data))
+                    await limiter.record_bytes(len(data))
+                    network_start = time.perf_counter()
+                with record.stage('write', len(buffer)):
+                    await flush_buffer(f, buffer)
+
+    part_size = os.path.getsize(part_path)
+    if total_size is not None and part_size != total_size:
+        raise IOError(f"incomplete download ({part_size} of {total_size} bytes)")
+
+    os.replace(part_path, save_path)
+    if manifest is not None:
+        manifest.mark_complete(os.path.basename(url), total_size, validator)
+    return True
+
+# Function to download one file, retrying with backoff. Throttling responses
+# also shrink the shared concurrency limit before the retry.
+async def download_file_async(session, limiter, stats, url, save_path, pbar, manifest=None, metrics=None):
+    import aiohttp
+
+    with track(metrics, os.path.basename(url)) as record:
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await limiter.acquire()
+            try:
+                downloaded = await fetch_file(session, limiter, stats, url, save_path, pbar, manifest, record)
+                stats.record_file(url)
+                return downloaded
+            except ThrottledError as e:
+                stats.record_throttle(url)
+                await limiter.throttled()
+                delay = e.retry_after if e.retry_after is not None else min(2 ** attempt, 60)
+            except (aiohttp.ClientError, asyncio.TimeoutError, IOError):
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                delay = min(2 ** attempt, 60)
+            finally:
+                await limiter.release()
+            await asyncio.sleep(delay)
+
+        raise IOError(f"gave up after {MAX_ATTEMPTS} throttled attempts")
+
+async def download_files_async_main(urls, save_folder, max_workers, initial_workers, manifest=None, metrics=None):
+    import aiohttp
+
+    limiter = AdaptiveLimiter(initial_workers, maximum=max_workers)
+    stats = HostStats()
+    errors = []
+
+    connector = aiohttp.TCPConnector(limit=max_workers, limit_per_host=max_workers)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        with tqdm(desc="Downloaded", unit='B', unit_scale=True, unit_divisor=1024, ncols=150, ascii=True) as bytes_pbar, \
+             tqdm(total=len(urls), desc="Overall Progress", ncols=100, ascii=True) as overall_pbar:
+
+            async def run(url):
+                save_path = os.path.join(save_folder, os.path.basename(url))
+                try:
+                    await download_file_async(session, limiter, stats, url, save_path, bytes_pbar, manifest, metrics)
+                except Exception as e:
+                    errors.append((url, e))
+                    tqdm.write(f"Error downloading {url}: {e}")
+                finally:
+                    overall_pbar.update(1)
+                    overall_pbar.set_postfix(in_flight=limiter.limit)
+
+            await asyncio.gather(*(run(url) for url in urls))
+
+    return stats.summary(), errors
+
+# Function to download a list of URLs with the asyncio engine. Returns the
+# per-host throughput summary and a list of (url, error) failures. Completed
+# files are recorded in 'manifest' and per-file stage timings in 'metrics'
+# when they are given. Raises ImportError if aiohttp isn't installed.
+def download_files_async(urls, save_folder, max_workers, initial_workers=4, manifest=None, metrics=None):
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        raise ImportError("The async engine requires aiohttp. Install it with 'pip install aiohttp'.")
+
+    return asyncio.run(download_files_async_main(urls, save_folder, max_workers, min(initial_workers, max_workers), manifest, metrics))
+
+# Function to print the per-host throughput summary
+def print_host_summary(summary):
+    for host, stats in summary.items():
+        print(f"{host}: {stats['files']} files, {stats['bytes'] / (1024 * 1024):.2f} MB in {stats['seconds']:.1f} s "
+              f"({stats['bytes_per_second'] / (1024 * 1024):.2f} MB/s, throttled {stats['throttled']} times)")
@@ -0,0 +1,333 @@
+import os
+import re
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import http.server
+import multiprocessing
+from datetime import timedelta
+
+# Benchmark harness for the AIRS order compiling, download, extraction,
+# crop/resize, render and GLM gridding stages. Synthetic GOES-R files are
+# generated into a work folder and served by a local HTTP server, then each
+# stage runs in its own process on the previous stage's output so its peak
+# memory can be measured on its own. AIRS order pages are served from saved
+# fixtures and the compiled source files checked against the expected ones.
+
+STAGES = ('airs', 'download', 'extract', 'crop', 'render', 'glm')
+
+# Saved AIRS order pages under download/<order>/<subscription>/, and the
+# source files compile_airs_sources.py should make of them under expected/
+AIRS_FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fixtures', 'airs')
+
+# Folders under the work folder written by each stage
+STAGE_OUTPUTS = {
+    'download': 'data',
+    'extract': 'extracted',
+    'crop': 'cropped',
+}
+
+# Static file handler with Range and ETag support, standing in for the
+# archive servers
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        f = open(path, 'rb')
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < size:
+            start = int(match.group(1))
+            f.seek(start)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+            self.send_header('Content-Length', str(size - start))
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(size))
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('ETag', f'"{stat.st_mtime_ns:x}-{size:x}"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to serve a folder on a free local port from a background thread.
+# Returns the server and its base URL.
+def start_file_server(directory):
+    handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=directory, **kwargs)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+def list_files(directory, suffix, contains=''):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(suffix) and contains in f)
+
+def total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def bench_airs(config):
+    from .compile_airs_sources import fetch_orders, index_orders, get_output_file_name
+
+    expected_dir = os.path.join(AIRS_FIXTURES_DIR, 'expected')
+    server, base_url = start_file_server(AIRS_FIXTURES_DIR)
+    # Source file names are <order>-<subscription>.txt
+    urls = [base_url + 'download/' + os.path.splitext(name)[0].replace('-', '/') for name in sorted(os.listdir(expected_dir))]
+    try:
+        start_time = time.perf_counter()
+        orders = index_orders(urls, fetch_orders(urls, config['workers']))
+        elapsed = time.perf_counter() - start_time
+    finally:
+        server.shutdown()
+
+    for url in urls:
+        with open(os.path.join(expected_dir, get_output_file_name(url)), 'r', encoding='utf-8') as f:
+            expected = f.read().split('\n')
+        if orders.get(url) != expected:
+            raise RuntimeError(f"the files compiled from {url} don't match {get_output_file_name(url)}")
+
+    pages = [os.path.join(root, f) for root, _, files in os.walk(os.path.join(AIRS_FIXTURES_DIR, 'download')) for f in files]
+    return sum(len(file_urls) for file_urls in orders.values()), total_size(pages), elapsed
+
+def bench_download(config):
+    from .get_data import download_files
+
+    fixtures = list_files(config['fixtures_dir'], '.nc')
+    save_folder = os.path.join(config['work_dir'], 'data', 'downloaded')
+    os.makedirs(save_folder, exist_ok=True)
+
+    server, base_url = start_file_server(config['fixtures_dir'])
+    urls = [base_url + os.path.basename(path) for path in fixtures]
+    try:
+        start_time = time.perf_counter()
+        if config['engine'] == 'async':
+            from .async_download import download_files_async
+            download_files_async(urls, save_folder, config['workers'])
+        else:
+            download_files(urls, save_folder, config['workers'])
+        elapsed = time.perf_counter() - start_time
+    finally:
+        server.shutdown()
+
+    downloaded = list_files(save_folder, '.nc')
+    return len(downloaded), total_size(downloaded), elapsed
+
+def bench_extract(config):
+    from .extract_img_data import run_tasks
+    from .goes_files import index_files, group_by_channel
+
+    data_dir = os.path.join(config['work_dir'], 'data', 'downloaded')
+    if not os.path.isdir(data_dir):
+        data_dir = config['fixtures_dir']
+    images_dir = os.path.join(config['work_dir'], 'extracted', 'images')
+
+    options = {
+        'export_format': config['export_format'],
+        'gray_scale': config['gray_scale'],
+        'apply_scaling': False,
+        'roi': None,
+        'array_store': None,
+        'colormap': 'viridis',
+        'png16': False,
+    }
+    tasks = []
+    for channel, files in group_by_channel(index_files(os.listdir(data_dir)), config['channels']).items():
+        os.makedirs(os.path.join(images_dir, channel), exist_ok=True)
+        for goes_file in files:
+            image_filename = os.path.join(images_dir, channel, f'image_{os.path.splitext(goes_file.name)[0]}.{config["export_format"]}')
+            tasks.append((os.path.join(data_dir, goes_file.name), image_filename, options))
+
+    start_time = time.perf_counter()
+    errors = run_tasks(tasks, config['workers'])
+    elapsed = time.perf_counter() - start_time
+    if errors:
+        raise RuntimeError(f"{len(errors)} files failed to extract, e.g. {errors[0][1]}")
+
+    return len(tasks), total_size(task[0] for task in tasks), elapsed
+
+def bench_crop(config):
+    from tqdm import tqdm
+    from .image_crop import resize_and_crop_images
+
+    images_dir = os.path.join(config['work_dir'], 'extracted', 'images')
+    cropped_dir = os.path.join(config['work_dir'], 'cropped', 'images')
+    selected_dirs = [os.path.join(images_dir, channel) for channel in config['channels']]
+    output_dirs = [os.path.join(cropped_dir, channel) for channel in config['channels']]
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+
+    images = [path for dir_path in selected_dirs for path in list_files(dir_path, '.' + config['export_format'])]
+    start_time = time.perf_counter()
+    with tqdm(total=len(images), disable=True) as progress_bar:
+        resize_and_crop_images(selected_dirs, output_dirs, config['export_format'], config['resize_resolution'], config['crop_area'], config['workers'], progress_bar)
+    elapsed = time.perf_counter() - start_time
+
+    return len(images), total_size(images), elapsed
+
+def bench_render(config):
+    import cv2
+    from .render_animation import list_image_frames, render_video
+
+    cropped_dir = os.path.join(config['work_dir'], 'cropped', 'images')
+    input_dirs = [os.path.join(cropped_dir, channel) for channel in config['channels']]
+    frames = list_image_frames(input_dirs, config['export_format'], timedelta(seconds=60))
+    if not frames:
+        raise RuntimeError("no frames to render")
+
+    output_video_path = os.path.join(config['work_dir'], 'animation.mp4')
+    start_time = time.perf_counter()
+    render_video(output_video_path, lambda channel_index, path: cv2.imread(path), frames, 10, 0.25, decode_workers=config['workers'])
+    elapsed = time.perf_counter() - start_time
+
+    return len(frames), total_size(path for frame in frames for path in frame), elapsed
+
+def bench_glm(config):
+    from .glm_grid import GLM_KINDS, make_grid, read_glm_file, WindowAccumulator
+
+    glm_files = list_files(config['fixtures_dir'], '.nc', contains='GLM-L2-LCFA')
+    grid = make_grid(8)
+    accumulator = WindowAccumulator(grid, GLM_KINDS)
+
+    start_time = time.perf_counter()
+    for path in glm_files:
+        accumulator.add(read_glm_file(path, GLM_KINDS, 'count', grid, 'G16'))
+    for kind in GLM_KINDS:
+        accumulator.density(kind)
+    elapsed = time.perf_counter() - start_time
+
+    return len(glm_files), total_size(glm_files), elapsed
+
+BENCHMARKS = {
+    'airs': bench_airs,
+    'download': bench_download,
+    'extract': bench_extract,
+    'crop': bench_crop,
+    'render': bench_render,
+    'glm': bench_glm,
+}
+
+# Entry point of the stage process. Progress bars and messages of the tools
+# are discarded unless 'verbose' is set.
+def run_stage(stage, config, results):
+    try:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.ExitStack() as stack:
+                if not config['verbose']:
+                    stack.enter_context(contextlib.redirect_stdout(devnull))
+                    stack.enter_context(contextlib.redirect_stderr(devnull))
+                files, size, elapsed = BENCHMARKS[stage](config)
+        from .metrics import get_peak_rss
+        results.put({'stage': stage, 'files': files, 'bytes': size, 'seconds': elapsed, 'peak_rss': get_peak_rss(children=True)})
+    except Exception as e:
+        results.put({'stage': stage, 'error': f"{type(e).__name__}: {e}"})
+
+# Function to generate the synthetic files in a process of their own. Linux
+# keeps the peak RSS of a process across fork and exec, so stage processes
+# started from a parent that had generated the files would all report at
+# least the generator's peak.
+def generate_fixtures(fixtures_dir, channels, frames, glm_files, scale):
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=run_generator, args=(fixtures_dir, channels, frames, glm_files, scale))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"generating synthetic data failed with exit code {process.exitcode}")
+
+def run_generator(fixtures_dir, channels, frames, glm_files, scale):
+    from .synthetic_data import generate_dataset
+    generate_dataset(fixtures_dir, channels, frames, glm_files, scale)
+
+# Function to run each stage in a fresh process, so peak RSS isn't carried
+# over from earlier stages
+def run_benchmarks(stages, config):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    report = []
+    for stage in stages:
+        process = context.Process(target=run_stage, args=(stage, config, results))
+        process.start()
+        process.join()
+        try:
+            result = results.get(timeout=5)
+        except queue.Empty:
+            result = {'stage': stage, 'error': f"stage process exited with code {process.exitcode}"}
+
+        if 'error' not in result:
+            result['files_per_second'] = result['files'] / max(result['seconds'], 1e-9)
+            result['megabytes_per_second'] = result['bytes'] / (1024 * 1024) / max(result['seconds'], 1e-9)
+        report.append(result)
+        print_result(result)
+    return report
+
+def print_result(result):
+    if 'error' in result:
+        print(f"{result['stage']:<10} failed: {result['error']}")
+        return
+    print(f"{result['stage']:<10} {result['files']:>6} files {result['bytes'] / (1024 * 1024):>9.2f} MB {result['seconds']:>8.2f} s "
+          f"{result['files_per_second']:>8.2f} files/s {result['megabytes_per_second']:>8.2f} MB/s "
+          f"peak RSS {(result['peak_rss'] or 0) / (1024 * 1024):>8.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AIRS compiling, download, extraction, crop, render and GLM stages on synthetic GOES-R data.')
+    parser.add_argument('--stages', nargs='*', choices=STAGES, default=list(STAGES), help='Stages to run, in order (default: all)')
+    parser.add_argument('--channels', nargs='*', default=['C01', 'C02', 'C13'], help='ABI channels to generate and process (default C01 C02 C13)')
+    parser.add_argument('--frames', type=int, default=6, help='Number of full disk scans per channel (default 6)')
+    parser.add_argument('--glm_files', type=int, default=30, help='Number of GLM files (default 30)')
+    parser.add_argument('--scale', type=float, default=0.25, help='Grid size relative to the real full disk (default 0.25)')
+    parser.add_argument('--workers', type=int, default=4, help='Workers used by each stage (default 4)')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads', help='Download engine (default threads)')
+    parser.add_argument('--export_format', default='jpg', help='Image format used by the extract, crop and render stages (default jpg)')
+    parser.add_argument('--gray_scale', action='store_true', help='Extract grayscale images')
+    parser.add_argument('--resize_resolution', type=int, nargs=2, default=[2400, 2400], help='Resize resolution of the crop stage (width height)')
+    parser.add_argument('--crop_area', type=int, nargs=4, default=[50, 450, 900, 1500], help='Crop area of the crop stage (top, bottom, left, right)')
+    parser.add_argument('--work_dir', help='Folder for fixtures and outputs (default: a temporary folder that is removed afterwards)')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help="Show the tools' own progress output")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='goes_benchmark_')
+    fixtures_dir = os.path.join(work_dir, 'fixtures')
+    try:
+        # The airs stage only uses the saved order pages
+        if set(args.stages) - {'airs'}:
+            if not os.path.isdir(fixtures_dir):
+                print(f"Generating synthetic data in '{fixtures_dir}'...")
+                generate_fixtures(fixtures_dir, args.channels, args.frames, args.glm_files, args.scale)
+            else:
+                print(f"Using existing synthetic data in '{fixtures_dir}'.")
+
+        # Outputs of an earlier run would let stages skip their work. Only the
+        # stages being run are cleared, so later stages can still run on the
+        # output an earlier run left behind.
+        for stage in args.stages:
+            if stage in STAGE_OUTPUTS:
+                shutil.rmtree(os.path.join(work_dir, STAGE_OUTPUTS[stage]), ignore_errors=True)
+
+        config = dict(vars(args), work_dir=work_dir, fixtures_dir=fixtures_dir)
+        report = run_benchmarks(args.stages, config)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'config': {k: v for k, v in config.items() if k not in ('json', 'verbose')}, 'results': report}, f, indent=2)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if any('error' in result for result in report):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
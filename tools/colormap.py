@@ -0,0 +1,191 @@
+import io
+import os
+import zlib
+import struct
+import numpy as np
+from functools import lru_cache
+from .metrics import FileMetrics
+
+# Vectorized replacement for plt.imsave. Arrays are normalized between their
+# own min and max, quantized straight to uint8 colormap indices and mapped
+# through a 256-entry lookup table, then encoded with Pillow. Pillow is only
+# imported when saving, and matplotlib only to build the lookup table for
+# colormaps other than gray.
+
+LUT_SIZE = 256
+
+# Formats that can store transparency for masked pixels
+ALPHA_FORMATS = ('png', 'tif', 'tiff', 'webp')
+
+# Function to get the (256, 3) uint8 RGB lookup table for a colormap
+@lru_cache(maxsize=None)
+def get_colormap_lut(name):
+    if name in ('gray', 'grey'):
+        return np.repeat(np.arange(LUT_SIZE, dtype=np.uint8)[:, np.newaxis], 3, axis=1)
+
+    import matplotlib
+    try:
+        cmap = matplotlib.colormaps[name]
+    except AttributeError:
+        import matplotlib.cm
+        cmap = matplotlib.cm.get_cmap(name)
+    return cmap(np.linspace(0, 1, LUT_SIZE), bytes=True)[:, :3]
+
+# Function to split a (possibly masked) array into float32 data and a mask of
+# valid pixels. NaN and infinite values count as masked.
+def split_valid(data):
+    mask = np.ma.getmaskarray(data) if np.ma.isMaskedArray(data) else None
+    data = np.asarray(np.ma.getdata(data), dtype=np.float32)
+    valid = np.isfinite(data)
+    if mask is not None:
+        valid &= ~mask
+    return data, valid
+
+# Function to get the normalization range of the valid pixels
+def get_value_range(data, valid):
+    if not valid.any():
+        return 0.0, 0.0
+    values = data if valid.all() else data[valid]
+    return float(values.min()), float(values.max())
+
+# Function to quantize data to 'levels' steps between vmin and vmax, matching
+# matplotlib's Normalize followed by a colormap lookup. Invalid pixels get
+# 'bad_index'.
+def quantize(data, valid, vmin, vmax, levels=LUT_SIZE, dtype=np.uint8, bad_index=0):
+    scale = levels / (vmax - vmin) if vmax > vmin else 0.0
+    scaled = np.subtract(data, vmin, dtype=np.float32)
+    scaled *= scale
+    np.clip(scaled, 0, levels - 1, out=scaled)
+    np.putmask(scaled, ~valid, bad_index)
+    return scaled.astype(dtype)
+
+# Function to build the lookup table used by render_image. Entry LUT_SIZE is
+# the colour of masked pixels, so one np.take produces the final image.
+@lru_cache(maxsize=None)
+def get_render_lut(cmap, alpha, bad_value):
+    lut = get_colormap_lut(cmap)
+    if cmap in ('gray', 'grey'):
+        lut = lut[:, :1]
+    if alpha:
+        lut = np.hstack((lut, np.full((LUT_SIZE, 1), 255, dtype=np.uint8)))
+        bad_value = 0
+    bad_color = np.full((1, lut.shape[1]), bad_value, dtype=np.uint8)
+    return np.vstack((lut, bad_color))
+
+# Function to render an array to an 8-bit image: L for gray, RGB otherwise,
+# or LA/RGBA when 'alpha' is set and some pixels are masked. Masked pixels
+# are transparent with alpha and 'bad_value' without.
+def render_image(data, cmap='viridis', vmin=None, vmax=None, alpha=False, bad_value=255):
+    data, valid = split_valid(data)
+    data_min, data_max = get_value_range(data, valid)
+    vmin = data_min if vmin is None else vmin
+    vmax = data_max if vmax is None else vmax
+    return render_valid(data, valid, cmap, vmin, vmax, alpha and not valid.all(), bad_value)
+
+# Function to render data with a fixed value range. Rendering the rows of an
+# image in strips with the range of the whole image, and 'alpha' resolved
+# for the whole image, gives the same pixels as render_image.
+def render_valid(data, valid, cmap, vmin, vmax, alpha=False, bad_value=255):
+    lut = get_render_lut(cmap, alpha, bad_value)
+    indices = quantize(data, valid, vmin, vmax, dtype=np.uint16, bad_index=LUT_SIZE)
+    image = np.take(lut, indices, axis=0)
+    return image[..., 0] if image.shape[-1] == 1 else image
+
+# Function to render an array to a lossless 16-bit grayscale image
+def render_gray16(data, vmin=None, vmax=None):
+    data, valid = split_valid(data)
+    data_min, data_max = get_value_range(data, valid)
+    vmin = data_min if vmin is None else vmin
+    vmax = data_max if vmax is None else vmax
+    return quantize(data, valid, vmin, vmax, levels=65536, dtype=np.uint16)
+
+# Function to save an array as an image, replacing plt.imsave. Masked pixels
+# come out transparent in formats with alpha and white otherwise, as before.
+# The image is encoded in memory and then written, so the two can be timed
+# separately in 'record'.
+def save_image(image_filename, data, export_format, cmap='viridis', png16=False, record=None):
+    if record is None:
+        record = FileMetrics(os.path.basename(image_filename))
+
+    from PIL import Image
+
+    export_format = export_format.lower()
+    with record.stage('transform'):
+        if png16:
+            if export_format != 'png':
+                raise ValueError("16-bit output is only supported for the png format")
+            image = Image.fromarray(render_gray16(data))
+            pil_format = 'png'
+        else:
+            image = Image.fromarray(render_image(data, cmap=cmap, alpha=export_format in ALPHA_FORMATS))
+            pil_format = 'jpeg' if export_format == 'jpg' else export_format
+
+    encode_image(image_filename, image, pil_format, record)
+
+# Function to encode a Pillow image in memory and write it
+def encode_image(image_filename, image, pil_format, record):
+    buffer = io.BytesIO()
+    with record.stage('encode'):
+        image.save(buffer, format=pil_format)
+
+    encoded = buffer.getbuffer()
+    with record.stage('write', encoded.nbytes):
+        with open(image_filename, 'wb') as f:
+            f.write(encoded)
+
+# PNG colour type for each number of channels: L, LA, RGB and RGBA
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# PNG encoder taking the image a strip of rows at a time, so an image never
+# has to be held in memory whole. Rows are filtered with the 'Up' filter,
+# which only needs the last row of the previous strip, and compressed into
+# IDAT chunks as they come in.
+class PNGStripWriter:
+    def __init__(self, f, width, height, channels=1, bit_depth=8, compress_level=6):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.bit_depth = bit_depth
+        self.rows = 0
+        self.previous_row = None
+        self.compressor = zlib.compressobj(compress_level)
+        self.bytes_written = 0
+
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.f.write(struct.pack('>I', len(data)) + chunk_type)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+        self.bytes_written += len(data) + 12
+
+    # Function to add the next rows, as a (rows, width) or (rows, width,
+    # channels) array of uint8, or uint16 for 16-bit images
+    def write_rows(self, rows):
+        dtype = '>u2' if self.bit_depth == 16 else np.uint8
+        raw = np.ascontiguousarray(rows, dtype=dtype).view(np.uint8).reshape(len(rows), -1)
+        if raw.shape[1] != self.width * self.channels * self.bit_depth // 8:
+            raise ValueError(f"expected rows of {self.width} pixels with {self.channels} channels")
+
+        # Filter type byte, then each byte minus the one above it (mod 256)
+        filtered = np.empty((len(raw), raw.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        np.subtract(raw[1:], raw[:-1], out=filtered[1:, 1:])
+        if self.previous_row is None:
+            filtered[0, 1:] = raw[0]
+        else:
+            np.subtract(raw[0], self.previous_row, out=filtered[0, 1:])
+        self.previous_row = raw[-1].copy()
+        self.rows += len(raw)
+
+        data = self.compressor.compress(filtered)
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f"PNG image has {self.rows} of {self.height} rows")
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
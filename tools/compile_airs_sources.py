@@ -1,41 +1,189 @@
-import sys
 import os
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
-from urllib.parse import urljoin
+import re
+import html
+import argparse
+import concurrent.futures
+from urllib.parse import urljoin, urlsplit
 from tqdm import tqdm  # Import tqdm for the progress bar
+from .get_data import create_session, REQUEST_TIMEOUT
+from .goes_files import parse_scan_start
+from .metrics import FileMetrics, track, add_metrics_argument, create_metrics
 
-# Get user input URL from command line arguments or prompt
-if len(sys.argv) > 1:
-    url = sys.argv[1]
-else:
-    url = input("Enter the URL: ")
-
-# Fetch the webpage content
-response = requests.get(url)
-html_content = response.text
-
-# Parse the HTML content
-soup = BeautifulSoup(html_content, 'html.parser')
-
-# Extract file names and their URLs
-file_urls = []
-base_url = urljoin(url, '/')  # Ensure base URL ends with '/'
-for link in soup.find_all('a', href=True):
-    if link['href'].endswith('.nc'):
-        file_urls.append(urljoin(base_url, link['href']))
-
-# Create the output file name
-output_file_name = url.split('/')[-2] + '-' + url.split('/')[-1] + '.txt'
-output_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_sources', output_file_name)
-
-# Write the URLs to the output file with a progress bar
-with open(output_file_path, 'w') as f, tqdm(total=len(file_urls), desc="Writing URLs") as pbar:
-    for i, file_url in enumerate(file_urls):
-        f.write(file_url)
-        if i < len(file_urls) - 1:  # Don't add newline for the last URL
-            f.write('\n')
-        pbar.update(1)  # Update the progress bar
-
-print(f"File URLs saved to: ..\\data_sources\\{output_file_name}")
+SOURCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_sources')
+
+# Anchor and link tags, and the attributes inside them. Order pages are
+# scanned with these as they stream in instead of being parsed into a tree.
+TAG_PATTERN = re.compile(r'<(?:a|link)\b[^>]*>', re.IGNORECASE)
+ATTRIBUTE_PATTERN = re.compile(r'''\b(href|rel)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+
+MAX_PAGES = 1000
+
+# Function to get the href and rel attributes of a tag
+def parse_tag(tag):
+    attributes = {}
+    for match in ATTRIBUTE_PATTERN.finditer(tag):
+        value = next(group for group in match.groups()[1:] if group is not None)
+        attributes[match.group(1).lower()] = html.unescape(value)
+    return attributes.get('href'), attributes.get('rel', '').lower().split()
+
+# Function to collect the .nc links of a piece of HTML. Returns the
+# rel="next" link if there is one.
+def scan_tags(text, page_url, file_urls):
+    next_url = None
+    for tag in TAG_PATTERN.findall(text):
+        href, rel = parse_tag(tag)
+        if not href:
+            continue
+        if urlsplit(href).path.endswith('.nc'):
+            file_urls.append(urljoin(page_url, href))
+        elif 'next' in rel:
+            next_url = urljoin(page_url, href)
+    return next_url
+
+# Function to extract the .nc links and the rel="next" link of a page from
+# a stream of text chunks. Only the text after the last '<' is carried over
+# between chunks, since any tag before it is already complete.
+def extract_links(chunks, page_url):
+    file_urls = []
+    next_url = None
+    carry = ''
+
+    for chunk in chunks:
+        text = carry + chunk
+        cut = text.rfind('<')
+        if cut == -1:
+            carry = ''
+            continue
+        next_url = scan_tags(text[:cut], page_url, file_urls) or next_url
+        carry = text[cut:]
+
+    next_url = scan_tags(carry, page_url, file_urls) or next_url
+    return file_urls, next_url
+
+# Function to fetch every page of an order, following rel="next" links.
+# Time spent waiting for the page is recorded as 'network' in 'record' and
+# the time scanning it as 'transform'.
+def fetch_order(session, url, record=None):
+    if record is None:
+        record = FileMetrics(url)
+    file_urls = []
+    page_url = url
+    visited = set()
+
+    while page_url and page_url not in visited and len(visited) < MAX_PAGES:
+        visited.add(page_url)
+        with record.stage('network'):
+            response = session.get(page_url, stream=True, timeout=REQUEST_TIMEOUT)
+        with response:
+            response.raise_for_status()
+            if response.encoding is None:
+                response.encoding = 'utf-8'
+            network_seconds = record.seconds['network']
+            with record.stage('transform'):
+                page_files, page_url = extract_links(record.timed(response.iter_content(chunk_size=64 * 1024, decode_unicode=True)), response.url)
+            record.add('transform', network_seconds - record.seconds['network'])
+        file_urls.extend(page_files)
+
+    return file_urls
+
+# Function to fetch many orders concurrently over one pooled session.
+# Returns {url: file URLs} for the orders that could be fetched.
+def fetch_orders(urls, workers, metrics=None):
+    session = create_session(pool_size=workers)
+    orders = {}
+
+    def fetch(url):
+        with track(metrics, url) as record:
+            return fetch_order(session, url, record)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        future_to_url = {executor.submit(fetch, url): url for url in urls}
+        for future in tqdm(concurrent.futures.as_completed(future_to_url), total=len(future_to_url), desc="Fetching orders"):
+            url = future_to_url[future]
+            try:
+                orders[url] = future.result()
+            except Exception as e:
+                tqdm.write(f"Error fetching {url}: {e}")
+
+    return orders
+
+# Function to drop files listed more than once, keeping the first listing
+# in the order the URLs were given, and sort each list by scan start time
+def index_orders(urls, orders):
+    seen = set()
+    indexed = {}
+    for url in urls:
+        if url not in orders:
+            continue
+        file_urls = []
+        for file_url in orders[url]:
+            name = os.path.basename(urlsplit(file_url).path)
+            if name in seen:
+                continue
+            seen.add(name)
+            file_urls.append(file_url)
+        indexed[url] = sorted(file_urls, key=source_sort_key)
+    return indexed
+
+# Sort by scan start time, with names outside the GOES-R convention last
+def source_sort_key(file_url):
+    name = os.path.basename(urlsplit(file_url).path)
+    start = parse_scan_start(name)
+    return (start is None, start or 0, name)
+
+# Function to create the output file name of an order, e.g.
+# https://.../download/0123456789/001 -> 0123456789-001.txt
+def get_output_file_name(url):
+    parts = url.rstrip('/').split('/')
+    return parts[-2] + '-' + parts[-1] + '.txt'
+
+def write_source_file(output_file_path, file_urls, metrics=None):
+    with track(metrics, os.path.basename(output_file_path)) as record:
+        text = '\n'.join(file_urls)
+        with record.stage('write', len(text)):
+            with open(output_file_path, 'w') as f:
+                f.write(text)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the .nc file URLs of AIRS order pages into data source files.')
+    parser.add_argument('urls', nargs='*', help='Order page URLs')
+    parser.add_argument('--input_file', help='File with one order page URL per line')
+    parser.add_argument('--workers', type=int, default=8, help='Number of orders fetched concurrently (default 8)')
+    parser.add_argument('--combined', help='Write the files of every order to a single data source file with this name')
+    parser.add_argument('--output_dir', default=SOURCE_FOLDER, help='Folder to write data source files to (default data_sources/)')
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+
+    urls = list(args.urls)
+    if args.input_file:
+        with open(args.input_file, 'r', encoding='utf-8') as input_file:
+            urls.extend(line.strip() for line in input_file if line.strip())
+    # Get user input URL if none were given
+    if not urls:
+        urls = [input("Enter the URL: ")]
+    urls = list(dict.fromkeys(urls))
+
+    metrics = create_metrics('compile_airs_sources', args.metrics)
+    orders = index_orders(urls, fetch_orders(urls, args.workers, metrics))
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.combined:
+        output_file_name = args.combined if args.combined.endswith('.txt') else args.combined + '.txt'
+        file_urls = sorted((file_url for file_urls in orders.values() for file_url in file_urls), key=source_sort_key)
+        write_source_file(os.path.join(args.output_dir, output_file_name), file_urls, metrics)
+        print(f"{len(file_urls)} file URLs from {len(orders)} orders saved to: {os.path.join(args.output_dir, output_file_name)}")
+    else:
+        for url, file_urls in orders.items():
+            output_file_name = get_output_file_name(url)
+            write_source_file(os.path.join(args.output_dir, output_file_name), file_urls, metrics)
+            print(f"{len(file_urls)} file URLs saved to: {os.path.join(args.output_dir, output_file_name)}")
+
+    if metrics is not None:
+        metrics.close()
+
+    if len(orders) < len(urls):
+        print(f"{len(urls) - len(orders)} of {len(urls)} orders could not be fetched.")
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import os
+import argparse
+from datetime import timedelta
+import numpy as np
+from tqdm import tqdm
+from .array_store import ArrayStore
+from .colormap import render_valid
+from .goes_files import parse_goes_time
+from .metrics import FileMetrics, add_metrics_argument, create_metrics
+from .render_animation import align_frames, prefetch_map
+from .tile_pyramid import downsample
+
+# Streaming compositor over the frames of an array store, in scan order:
+#  - band composites: true color from C01/C02/C03, any three channels as RGB,
+#    or a single channel;
+#  - temporal operations over a sliding window of frames: rolling mean,
+#    max and min, and the difference with the frame 'window' frames earlier
+#    for change detection;
+#  - frame interpolation between output frames for smoother animations.
+# Frames are read from the memory-mapped store on background threads and
+# brought to the output size before any temporal work, and each temporal
+# operation keeps its window in a fixed ring buffer, so memory doesn't grow
+# with the number of frames in the order.
+
+COMPOSITES = ('truecolor', 'rgb', 'band')
+TEMPORAL_OPERATIONS = ('mean', 'max', 'min', 'difference')
+TRUECOLOR_CHANNELS = ('C01', 'C02', 'C03')
+
+# Weights of the blue, red and veggie (0.86 um) bands in the synthetic green
+# band, as in the CIMSS natural true color recipe
+GREEN_WEIGHTS = (0.45, 0.45, 0.1)
+
+# Ring buffer holding the last 'size' frames
+class FrameRing:
+    def __init__(self, size):
+        self.size = size
+        self.frames = None
+        self.filled = 0
+        self.next_index = 0
+
+    # Function to add a frame. Returns a copy of the frame it replaced once
+    # the ring is full, i.e. the frame 'size' frames earlier, or None.
+    def push(self, frame):
+        if self.frames is None:
+            self.frames = np.empty((self.size,) + frame.shape, dtype=np.float32)
+        replaced = self.frames[self.next_index].copy() if self.filled == self.size else None
+        self.frames[self.next_index] = frame
+        self.next_index = (self.next_index + 1) % self.size
+        self.filled = min(self.filled + 1, self.size)
+        return replaced
+
+    # The frames in the window, in no particular order
+    def window(self):
+        return self.frames[:self.filled]
+
+# Rolling mean of the valid pixels of the last 'size' frames. Sums are
+# updated as frames enter and leave the window, and recomputed from the ring
+# once per window so float32 rounding can't build up over long orders.
+class RollingMean:
+    def __init__(self, size):
+        self.ring = FrameRing(size)
+        self.total = None
+        self.count = None
+        self.pushed = 0
+
+    def push(self, frame):
+        replaced = self.ring.push(frame)
+        self.pushed += 1
+        if self.total is None or self.pushed % self.ring.size == 0:
+            window = self.ring.window()
+            valid = ~np.isnan(window)
+            self.total = np.where(valid, window, 0).sum(axis=0, dtype=np.float32)
+            self.count = valid.sum(axis=0, dtype=np.float32)
+        else:
+            for sign, values in ((1, frame), (-1, replaced)):
+                if values is None:
+                    continue
+                valid = ~np.isnan(values)
+                self.total += sign * np.where(valid, values, 0)
+                self.count += sign * valid
+        # Rounding can leave a residue in 'total' where no valid frame is
+        # left, so pixels without a count are masked explicitly
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total / self.count, np.nan)
+
+# Rolling maximum or minimum of the last 'size' frames, ignoring NaN
+class RollingExtreme:
+    def __init__(self, size, reduce):
+        self.ring = FrameRing(size)
+        self.reduce = reduce
+
+    def push(self, frame):
+        self.ring.push(frame)
+        return self.reduce.reduce(self.ring.window(), axis=0)
+
+# Difference between each frame and the frame 'size' frames earlier. Nothing
+# is output until the window is full.
+class RollingDifference:
+    def __init__(self, size):
+        self.ring = FrameRing(size)
+
+    def push(self, frame):
+        earlier = self.ring.push(frame)
+        return None if earlier is None else frame - earlier
+
+def create_temporal_operation(operation, window):
+    if operation == 'mean':
+        return RollingMean(window)
+    if operation == 'max':
+        return RollingExtreme(window, np.fmax)
+    if operation == 'min':
+        return RollingExtreme(window, np.fmin)
+    if operation == 'difference':
+        return RollingDifference(window)
+    raise ValueError(f"unknown temporal operation '{operation}'")
+
+# Function to bring a band to 'shape'. Power of two reductions (e.g. 0.5 km
+# C02 onto the 1 km grid) average the valid pixels 2x2, anything else is
+# resampled by area.
+def match_size(data, shape):
+    while data.shape[0] >= 2 * shape[0] and data.shape[1] >= 2 * shape[1]:
+        data = downsample(data)
+    if data.shape[:2] != tuple(shape):
+        import cv2
+        data = cv2.resize(data, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    return data
+
+# Function to read the region of a band from the store. 'region' is given in
+# pixels of the reference grid and scaled to the band's own grid, so only the
+# rows the region covers are read from the memory map.
+def read_band(store, channel, key, region, reference_shape):
+    array = store.read(channel, key)
+    factor_y = array.shape[0] / reference_shape[0]
+    factor_x = array.shape[1] / reference_shape[1]
+    top, bottom, left, right = region
+    data = np.array(array[int(top * factor_y):int(bottom * factor_y), int(left * factor_x):int(right * factor_x)], dtype=np.float32)
+    return match_size(data, (bottom - top, right - left))
+
+# Function to build a true color image in [0, 1] from blue (C01), red (C02)
+# and veggie (C03) reflectance, with a synthetic green band and gamma
+# correction
+def truecolor(blue, red, veggie, gamma=2.2):
+    green = GREEN_WEIGHTS[0] * blue + GREEN_WEIGHTS[1] * red + GREEN_WEIGHTS[2] * veggie
+    rgb = np.stack((red, green, blue), axis=-1)
+    np.clip(rgb, 0, 1, out=rgb)
+    return np.power(rgb, 1 / gamma, out=rgb)
+
+# Function to get the value range to render with from the first output frame.
+# Differences get a range symmetric around 0; three band images get one
+# range per band.
+def get_render_range(data, composite, operation, vmin=None, vmax=None):
+    if vmin is not None and vmax is not None:
+        return vmin, vmax
+
+    axis = (0, 1) if data.ndim == 3 else None
+    with np.errstate(invalid='ignore'):
+        if operation == 'difference':
+            extent = np.nanmax(np.abs(data), axis=axis)
+            data_min, data_max = -extent, extent
+        elif composite == 'truecolor':
+            data_min, data_max = 0.0, 1.0
+        else:
+            data_min, data_max = np.nanmin(data, axis=axis), np.nanmax(data, axis=axis)
+    data_min = np.nan_to_num(data_min)
+    data_max = np.nan_to_num(data_max)
+    return (data_min if vmin is None else vmin), (data_max if vmax is None else vmax)
+
+# Function to render a composite to an 8-bit BGR frame for OpenCV. Single
+# bands go through the colormap, three band images are scaled per band.
+# Pixels without data are black.
+def render_frame(data, vmin, vmax, cmap):
+    if data.ndim == 2:
+        image = render_valid(data, ~np.isnan(data), cmap, vmin, vmax, bad_value=0)
+        if image.ndim == 2:
+            image = np.repeat(image[..., np.newaxis], 3, axis=2)
+        return np.ascontiguousarray(image[..., ::-1])
+
+    span = np.where(np.asarray(vmax) > np.asarray(vmin), np.asarray(vmax) - np.asarray(vmin), 1)
+    scaled = (data - np.asarray(vmin, dtype=np.float32)) * (255 / np.asarray(span, dtype=np.float32))
+    np.clip(scaled, 0, 255, out=scaled)
+    scaled[np.isnan(scaled)] = 0
+    return np.ascontiguousarray(scaled.astype(np.uint8)[..., ::-1])
+
+# Function to generate 'steps' frames between two rendered frames, either
+# cross-fading them or following the motion between them. With 'flow', dense
+# optical flow from the first frame to the second is estimated once and each
+# frame samples both ends part of the way along it.
+def interpolate_frames(previous, current, steps, method='blend'):
+    import cv2
+
+    if method == 'flow':
+        flow = cv2.calcOpticalFlowFarneback(cv2.cvtColor(previous, cv2.COLOR_BGR2GRAY), cv2.cvtColor(current, cv2.COLOR_BGR2GRAY),
+                                            None, 0.5, 3, 15, 3, 5, 1.2, 0)
+        grid_y, grid_x = np.mgrid[0:previous.shape[0], 0:previous.shape[1]].astype(np.float32)
+
+    for step in range(1, steps + 1):
+        t = step / (steps + 1)
+        if method == 'flow':
+            previous_warped = cv2.remap(previous, grid_x - t * flow[..., 0], grid_y - t * flow[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            current_warped = cv2.remap(current, grid_x + (1 - t) * flow[..., 0], grid_y + (1 - t) * flow[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            yield cv2.addWeighted(previous_warped, 1 - t, current_warped, t, 0)
+        else:
+            yield cv2.addWeighted(previous, 1 - t, current, t, 0)
+
+# Writer for the output frames, to a video and/or numbered image files
+class FrameWriter:
+    def __init__(self, output_video_path, frames_dir, video_fps, export_format='png'):
+        self.output_video_path = output_video_path
+        self.frames_dir = frames_dir
+        self.video_fps = video_fps
+        self.export_format = export_format
+        self.video_writer = None
+        self.frames_written = 0
+        if frames_dir is not None:
+            os.makedirs(frames_dir, exist_ok=True)
+
+    def write(self, image, name, record):
+        import cv2
+        from .image_crop import write_image
+
+        if self.output_video_path is not None:
+            if self.video_writer is None:
+                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                self.video_writer = cv2.VideoWriter(self.output_video_path, fourcc, self.video_fps, (image.shape[1], image.shape[0]))
+            # The video writer encodes and writes in one call
+            with record.stage('encode', image.nbytes):
+                self.video_writer.write(image)
+        if self.frames_dir is not None:
+            write_image(os.path.join(self.frames_dir, f'{name}.{self.export_format}'), image, record)
+        self.frames_written += 1
+
+    def close(self):
+        if self.video_writer is not None:
+            self.video_writer.release()
+
+# Function to composite the frames of an array store, without prompting.
+# 'region' (top, bottom, left, right) is in pixels of the coarsest selected
+# channel's grid and 'size' (width, height) is the output size, by default
+# the region's. Returns the number of frames written (including
+# interpolated ones) and the video path.
+def composite_array_store(store_dir, composite='truecolor', channels=None, operation=None, window=6, interpolate=0, interpolation='blend',
+                          region=None, size=None, video_fps=10, output_video_path=None, frames_dir=None, export_format='png', colormap=None,
+                          vmin=None, vmax=None, gamma=2.2, time_tolerance=60, prefetch=4, decode_workers=2, no_video=False, metrics=None):
+    import cv2
+
+    store = ArrayStore(store_dir)
+    if composite == 'truecolor':
+        channels = list(channels or TRUECOLOR_CHANNELS)
+        if len(channels) != 3:
+            raise ValueError("true color needs the blue, red and veggie channels (C01 C02 C03)")
+    elif composite == 'rgb' and (not channels or len(channels) != 3):
+        raise ValueError("rgb composites need three channels (red, green, blue)")
+    elif composite == 'band' and (not channels or len(channels) != 1):
+        raise ValueError("band composites need one channel")
+    if composite not in COMPOSITES:
+        raise ValueError(f"unknown composite '{composite}'")
+    if operation is not None and operation not in TEMPORAL_OPERATIONS:
+        raise ValueError(f"unknown temporal operation '{operation}'")
+
+    missing = [channel for channel in channels if not store.keys(channel)]
+    if missing:
+        raise ValueError(f"no frames of {', '.join(missing)} in array store '{store_dir}'")
+
+    frames = align_frames([[(parse_goes_time(key), key) for key in store.keys(channel)] for channel in channels], timedelta(seconds=time_tolerance))
+    if not frames:
+        raise ValueError("no frames to composite")
+
+    # Every band is brought to the grid of the coarsest channel
+    shapes = [store.read(channel, key).shape for channel, key in zip(channels, frames[0])]
+    reference_shape = min(shapes)
+    region = tuple(region) if region else (0, reference_shape[0], 0, reference_shape[1])
+    top, bottom, left, right = region
+    if not (0 <= top < bottom <= reference_shape[0] and 0 <= left < right <= reference_shape[1]):
+        raise ValueError(f"region {region} is outside the {reference_shape[1]}x{reference_shape[0]} grid")
+    size = tuple(size) if size else (right - left, bottom - top)
+
+    name = '_'.join([composite if composite == 'truecolor' else '_'.join(channels)] + ([f'{operation}{window}'] if operation else []))
+    if output_video_path is None and not no_video:
+        output_dir = os.path.dirname(os.path.normpath(store_dir))
+        output_video_path = os.path.join(output_dir, f'{os.path.basename(output_dir)}_{name}_composite.mp4')
+    if no_video:
+        output_video_path = None
+    if output_video_path is None and frames_dir is None:
+        raise ValueError("nothing to write: no video and no frames folder")
+
+    if colormap is None:
+        colormap = 'RdBu_r' if operation == 'difference' else 'gray'
+
+    # Read, combine and resize the bands of a frame; runs on the prefetch threads
+    def load_composite(keys):
+        record = FileMetrics(keys[0])
+        with record.stage('read'):
+            bands = [read_band(store, channel, key, region, reference_shape) for channel, key in zip(channels, keys)]
+        record.add('read', 0.0, sum(band.nbytes for band in bands))
+        with record.stage('transform'):
+            if composite == 'truecolor':
+                data = truecolor(*bands, gamma=gamma)
+            elif composite == 'rgb':
+                data = np.stack(bands, axis=-1)
+            else:
+                data = bands[0]
+            if (data.shape[1], data.shape[0]) != size:
+                data = cv2.resize(data, size, interpolation=cv2.INTER_AREA)
+        return data, record
+
+    temporal = create_temporal_operation(operation, window) if operation else None
+    writer = FrameWriter(output_video_path, frames_dir, video_fps, export_format)
+    render_range = None
+    previous = None
+
+    try:
+        # The prefetched frames come first so prefetch_map runs to the end
+        # and shuts its executor down before zip stops
+        for future, keys in tqdm(zip(prefetch_map(load_composite, frames, prefetch, decode_workers), frames), total=len(frames), desc=f'Compositing {name}', unit='frame'):
+            data, record = future.result()
+            with record.stage('transform'):
+                if temporal is not None:
+                    data = temporal.push(data)
+                if data is not None:
+                    if render_range is None:
+                        render_range = get_render_range(data, composite, operation, vmin, vmax)
+                    image = render_frame(data, *render_range, colormap)
+
+            # Differences start once the window has filled up
+            if data is not None:
+                if previous is not None and interpolate > 0:
+                    for step, between in enumerate(interpolate_frames(previous[1], image, interpolate, interpolation), start=1):
+                        writer.write(between, f'{name}_s{previous[0]}_{step:02d}', record)
+                writer.write(image, f'{name}_s{keys[0]}', record)
+                previous = (keys[0], image)
+            if metrics is not None:
+                metrics.add(record)
+    finally:
+        writer.close()
+
+    return writer.frames_written, output_video_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Composite array store frames in scan order: band composites, rolling temporal statistics, change detection and frame interpolation.')
+    parser.add_argument('array_store', help='Array store written with --save_arrays (e.g. extracted_data/<order>/arrays)')
+    parser.add_argument('--composite', choices=COMPOSITES, default='truecolor', help='truecolor from C01/C02/C03, rgb from three --channels, or a single --channels band (default truecolor)')
+    parser.add_argument('--channels', nargs='*', help='Channels of the composite: red green blue for rgb, one for band')
+    parser.add_argument('--temporal', choices=TEMPORAL_OPERATIONS, help='Rolling mean/max/min over the last --window frames, or the difference with the frame --window frames earlier')
+    parser.add_argument('--window', type=int, default=6, help='Frames in the temporal window (default 6)')
+    parser.add_argument('--interpolate', type=int, default=0, help='Frames generated between consecutive frames (default 0)')
+    parser.add_argument('--interpolation', choices=['blend', 'flow'], default='blend', help='Cross-fade, or follow the motion between frames with optical flow (default blend)')
+    parser.add_argument('--region', type=int, nargs=4, metavar=('TOP', 'BOTTOM', 'LEFT', 'RIGHT'), help='Region to composite, in pixels of the coarsest channel (default: the whole grid)')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), help='Output frame size (default: the region size)')
+    parser.add_argument('--video_fps', type=int, default=10, help='Frames per second for the output video (default 10)')
+    parser.add_argument('--output', help='Output video path (default: <order>_<composite>_composite.mp4 next to the array store)')
+    parser.add_argument('--no_video', action='store_true', help="Don't write a video, only --frames_dir")
+    parser.add_argument('--frames_dir', help='Also write every output frame as an image to this folder')
+    parser.add_argument('--export_format', default='png', help='Image format used with --frames_dir (default png)')
+    parser.add_argument('--colormap', help='Colormap of single band composites (default gray, RdBu_r for differences)')
+    parser.add_argument('--vmin', type=float, help='Value shown as the low end of the colormap (default: from the first frame)')
+    parser.add_argument('--vmax', type=float, help='Value shown as the high end of the colormap (default: from the first frame)')
+    parser.add_argument('--gamma', type=float, default=2.2, help='Gamma correction of true color composites (default 2.2)')
+    parser.add_argument('--time_tolerance', type=float, default=60, help='Maximum difference in seconds between scan start times of channels combined into a frame (default 60)')
+    parser.add_argument('--prefetch', type=int, default=4, help='Number of frames read ahead of the compositor (default 4)')
+    parser.add_argument('--decode_workers', type=int, default=2, help='Number of threads reading frames (default 2)')
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+
+    if args.window < 1:
+        parser.error('--window must be at least 1')
+    if args.no_video and not args.frames_dir:
+        parser.error('--no_video requires --frames_dir')
+
+    metrics = create_metrics('composite', args.metrics)
+    try:
+        frames_written, output_video_path = composite_array_store(
+            args.array_store, args.composite, args.channels, args.temporal, args.window, args.interpolate, args.interpolation,
+            args.region, args.size, args.video_fps, args.output, args.frames_dir, args.export_format, args.colormap,
+            args.vmin, args.vmax, args.gamma, args.time_tolerance, args.prefetch, args.decode_workers, args.no_video, metrics)
+    except ValueError as e:
+        print(f"Nothing composited: {e}.")
+        exit(1)
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+    if output_video_path is not None:
+        print(f'{frames_written} frames written to "{output_video_path}".')
+    if args.frames_dir:
+        print(f"{frames_written} frames saved to '{args.frames_dir}'.")
+
+if __name__ == "__main__":
+    main()
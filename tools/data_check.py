@@ -1,19 +1,66 @@
 import os
+import time
+import argparse
+import concurrent.futures
+from .manifest import Manifest, MISSING, PARTIAL, UNVERIFIED, COMPLETE, CORRUPT
+from .get_data import select_source_file, read_source_urls, get_save_path, get_session, get_remote_info
 
-folder_path = "../data/8335455739-001"
-text_file_path = "../data_sources/8335455739-001.txt"
+STATES = (COMPLETE, UNVERIFIED, PARTIAL, MISSING, CORRUPT)
 
-# Get the list of file names in the folder
-folder_files = os.listdir(folder_path)
+# Function to ask the server for the size of files whose expected size isn't
+# known yet (e.g. downloaded before the manifest existed)
+def fetch_remote_sizes(manifest, max_workers):
+    rows = [row for row in manifest.rows() if row['size'] is None]
+    if not rows:
+        return
 
-# Read the list of file names from the text file
-with open(text_file_path, "r") as file:
-    text_file_names = file.read().splitlines()
+    def head(row):
+        size, validator = get_remote_info(get_session(), row['url'])
+        if size is not None:
+            manifest.record_remote(row['name'], size, validator)
 
-# Find missing names
-missing_names = set(text_file_names) - set(folder_files)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(head, row) for row in rows]):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error checking remote size: {e}")
 
-# Print missing names
-for name in missing_names:
-    print(name)
+def main():
+    parser = argparse.ArgumentParser(description='Check a download folder against its data source file.')
+    parser.add_argument('input_file_path', nargs='?', default='', help='Path to the data source file containing URLs')
+    parser.add_argument('--data_dir', help='Download folder to check (default data/<source file name>)')
+    parser.add_argument('--remote', action='store_true', help='Ask the server for the size of files whose expected size is not known yet')
+    parser.add_argument('--verify', action='store_true', help='Check the netCDF/HDF5 header of every downloaded file')
+    parser.add_argument('--checksum', action='store_true', help='With --verify, also compare SHA-256 checksums with those from the previous --checksum run')
+    parser.add_argument('--list', nargs='*', choices=STATES, default=[MISSING, PARTIAL, CORRUPT], help='States of the files to list (default missing partial corrupt)')
+    parser.add_argument('--max_workers', type=int, default=20, help='Number of concurrent requests for --remote')
+    args = parser.parse_args()
 
+    if not args.input_file_path:
+        args.input_file_path = select_source_file()
+        if args.input_file_path is None:
+            return
+
+    urls = read_source_urls(args.input_file_path)
+    data_dir = args.data_dir or get_save_path(args.input_file_path)
+
+    start_time = time.time()
+
+    manifest = Manifest(data_dir)
+    manifest.add_urls(urls)
+    if args.remote:
+        fetch_remote_sizes(manifest, args.max_workers)
+    summary = manifest.refresh()
+    if args.verify:
+        summary = manifest.verify(checksum=args.checksum)
+
+    for row in manifest.rows(states=args.list):
+        print(f"{row['state']:<10} {row['name']}")
+
+    print(f"\n{len(urls)} files in {os.path.basename(args.input_file_path)}: " + ', '.join(f"{summary.get(state, 0)} {state}" for state in STATES))
+    print(f"Checked in {time.time() - start_time:.3f} s")
+    manifest.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
 import os
 import argparse
 import numpy as np
-from netCDF4 import Dataset
-from PIL import Image
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import signal
+import contextlib
+import concurrent.futures
+from .goes_files import index_files, filter_files, group_by_channel, parse_time_argument
+from .goes_projection import latlon_box_to_pixels
+from .array_store import ArrayStore, store_key
+from .extraction_index import ExtractionIndex, hash_options, is_current
+from .colormap import save_image, encode_image, split_valid, get_value_range, render_valid, quantize, PNGStripWriter, ALPHA_FORMATS
+from .metrics import FileMetrics, add_metrics_argument, create_metrics
+from .tile_pyramid import TilePyramidWriter, write_tile_pyramid, get_frame_dir, METADATA_FILENAME
 
 # Function to handle ctrl-c interruption
 def signal_handler(sig, frame):
@@ -19,11 +25,11 @@ def select_data_directory():
     if not data_folders:
         print("No data folders found in '../data/' directory. Please specify the 'data_dir' flag.")
         exit(1)
-    
+
     print("Available data folders:")
     for i, folder in enumerate(data_folders):
         print(f"{i + 1}. {folder}")
-    
+
     try:
         selection = int(input("\nSelect a data folder by entering its index: "))
         if 1 <= selection <= len(data_folders):
@@ -35,65 +41,389 @@ def select_data_directory():
         print("Invalid input. Exiting.")
         exit(1)
 
-# Register ctrl-c handler
-signal.signal(signal.SIGINT, signal_handler)
-
-# Parse command line arguments
-parser = argparse.ArgumentParser(description='Extract and process imagery data from netCDF files.')
-parser.add_argument('data_dir', nargs='?', help='Directory containing netCDF files or network address')
-parser.add_argument('selected_channel_band_ids', nargs='+', help='Selected channel identifiers (e.g., C01 C02 C03)')
-parser.add_argument('--export_format', default='jpg', help='Export image format')
-parser.add_argument('--gray_scale', action='store_true', help='Convert images to grayscale')
-parser.add_argument('--apply_scaling', action='store_true', help='Apply scaling to images')
-args = parser.parse_args()
-
-# If data_dir is not specified, prompt the user to select a data folder
-if not args.data_dir:
-    args.data_dir = select_data_directory()
-
-# List all netCDF files in the directory
-try:
-    file_list = [f for f in os.listdir(args.data_dir) if f.endswith('.nc')]
-except FileNotFoundError:
-    print(f"Data directory '{args.data_dir}' not found. Please make sure it exists.")
-    exit(1)
-
-# Extract the parent folder name from the data_dir
-parent_folder_name = os.path.basename(os.path.normpath(args.data_dir))
-
-# Create a directory to store extracted data
-output_data_dir = os.path.join('extracted_data', parent_folder_name)
-os.makedirs(output_data_dir, exist_ok=True)
-
-# Create a directory to store extracted images
-output_images_dir = os.path.join(output_data_dir, 'images')
-os.makedirs(output_images_dir, exist_ok=True)
-
-# Extract images from netCDF files and save them
-for selected_channel_band_id in args.selected_channel_band_ids:
-    channel_output_dir = os.path.join(output_images_dir, selected_channel_band_id)
-    os.makedirs(channel_output_dir, exist_ok=True)
-
-    for frame, nc_file in enumerate(tqdm(file_list, desc=f'Extracting {selected_channel_band_id} Images', unit='file')):
-        if f'M6{selected_channel_band_id}' in nc_file:
-            dataset = Dataset(os.path.join(args.data_dir, nc_file), 'r')
-            imagery_data = dataset.variables['CMI'][:]
-            
-            # Apply scaling if specified
-            if args.apply_scaling:
-                scaled_imagery_data = np.array(Image.fromarray(imagery_data).resize((imagery_data.shape[1], imagery_data.shape[0])))
-            else:
-                scaled_imagery_data = imagery_data
-            
-            # Get the original filename without extension
-            original_filename = os.path.splitext(nc_file)[0]
-            
-            # Save the scaled image
-            image_filename = os.path.join(channel_output_dir, f'image_{original_filename}.{args.export_format}')
-            
-            if args.gray_scale:
-                plt.imsave(image_filename, scaled_imagery_data, cmap='gray', format=args.export_format)
+# Function to resolve a region of interest to pixel bounds on a file's grid.
+# 'roi' is ('pixels', (top, bottom, left, right)) or
+# ('latlon', (lat_min, lat_max, lon_min, lon_max)).
+def resolve_roi(dataset, roi):
+    kind, bounds = roi
+    if kind == 'latlon':
+        return latlon_box_to_pixels(dataset, *bounds)
+
+    height, width = dataset.variables['CMI'].shape
+    top, bottom, left, right = bounds
+    return max(0, top), min(height, bottom), max(0, left), min(width, right)
+
+# Function to get the pixel bounds (top, bottom, left, right) to read: the
+# region of interest, or the whole grid without one
+def get_region(dataset, roi=None):
+    if roi is None:
+        height, width = dataset.variables['CMI'].shape
+        return 0, height, 0, width
+
+    top, bottom, left, right = resolve_roi(dataset, roi)
+    if bottom <= top or right <= left:
+        raise ValueError(f"region of interest {roi[1]} is empty on this grid")
+    return top, bottom, left, right
+
+# Function to read the CMI variable, or only the hyperslab covering the
+# region of interest so the rest of the full disk is never decoded
+def read_imagery_data(dataset, roi=None):
+    if roi is None:
+        return dataset.variables['CMI'][:]
+
+    top, bottom, left, right = get_region(dataset, roi)
+    return dataset.variables['CMI'][top:bottom, left:right]
+
+# Approximate working memory per pixel of a strip: the decoded masked array,
+# its float32 copy and mask, the scaled values and quantized indices, and
+# the rendered and filtered rows
+STRIP_BYTES_PER_PIXEL = 32
+
+# Pillow image mode of 8-bit images by number of channels
+IMAGE_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+# Function to get the number of rows per strip that fits in 'max_memory'
+# bytes. Strips are a multiple of the variable's chunk rows when possible
+# so each compressed chunk is only decoded once per pass.
+def get_strip_rows(variable, width, max_memory):
+    rows = max(1, max_memory // (width * STRIP_BYTES_PER_PIXEL))
+    chunking = variable.chunking()
+    if chunking != 'contiguous' and rows >= chunking[0]:
+        rows -= rows % chunking[0]
+    return rows
+
+# Function to split rows top..bottom into strips whose boundaries fall on
+# multiples of 'strip_rows' in grid coordinates
+def strip_bounds(top, bottom, strip_rows):
+    start = top
+    while start < bottom:
+        end = min(bottom, (start // strip_rows + 1) * strip_rows)
+        yield start, end
+        start = end
+
+# Function to extract a netCDF file in strips of rows, keeping the working
+# memory near 'max_memory' bytes however large the grid is. A first pass
+# finds the value range of the whole image (and writes the array store);
+# the second renders each strip with that range. PNG images are streamed to
+# disk as they're rendered. Other formats can't be encoded in pieces, so the
+# strips are pasted into a Pillow image that is encoded whole; that image
+# and the encoded file come on top of 'max_memory'. The pixels match
+# extract_image without apply_scaling.
+def extract_image_strips(nc_path, image_filename, export_format, gray_scale, max_memory, roi=None, array_store=None, colormap='viridis', png16=False, tiles=None, record=None):
+    if record is None:
+        record = FileMetrics(os.path.basename(nc_path))
+
+    from netCDF4 import Dataset
+
+    export_format = export_format.lower()
+    if png16 and export_format != 'png':
+        raise ValueError("16-bit output is only supported for the png format")
+
+    with Dataset(nc_path, 'r') as dataset:
+        variable = dataset.variables['CMI']
+        top, bottom, left, right = get_region(dataset, roi)
+        height, width = bottom - top, right - left
+        strips = list(strip_bounds(top, bottom, get_strip_rows(variable, width, max_memory)))
+
+        def read_strip(start, end):
+            with record.stage('read'):
+                rows = variable[start:end, left:right]
+            record.add('read', 0.0, rows.nbytes)
+            return rows
+
+        # First pass: range of the valid pixels and whether any are masked
+        vmin, vmax = np.inf, -np.inf
+        all_valid = True
+        with contextlib.ExitStack() as stack:
+            write_rows = None
+            if array_store is not None:
+                write_rows = stack.enter_context(ArrayStore(array_store).writer(*store_key(nc_path), (height, width)))
+
+            for start, end in strips:
+                rows = read_strip(start, end)
+                with record.stage('transform'):
+                    data, valid = split_valid(rows)
+                    if valid.any():
+                        strip_min, strip_max = get_value_range(data, valid)
+                        vmin, vmax = min(vmin, strip_min), max(vmax, strip_max)
+                    all_valid = all_valid and bool(valid.all())
+                if write_rows is not None:
+                    with record.stage('write', data.nbytes):
+                        write_rows(rows)
+                del rows, data, valid
+
+        if vmin > vmax:
+            vmin = vmax = 0.0
+
+        # Second pass: render each strip with the range of the whole image
+        alpha = export_format in ALPHA_FORMATS and not all_valid
+        channels = 1 if png16 or gray_scale else 3
+        channels += alpha and not png16
+
+        pyramid = None
+        if tiles is not None:
+            pyramid = TilePyramidWriter(get_frame_dir(tiles, nc_path), width, height, vmin, vmax, export_format, 'gray' if gray_scale else colormap, png16, record)
+
+        with contextlib.ExitStack() as stack:
+            if export_format == 'png':
+                f = stack.enter_context(open(image_filename, 'wb'))
+                png_writer = PNGStripWriter(f, width, height, channels, bit_depth=16 if png16 else 8)
             else:
-                plt.imsave(image_filename, scaled_imagery_data, format=args.export_format)
+                from PIL import Image
+                image = Image.new(IMAGE_MODES[channels], (width, height))
+
+            for start, end in strips:
+                rows = read_strip(start, end)
+                with record.stage('transform'):
+                    data, valid = split_valid(rows)
+                    if png16:
+                        image_rows = quantize(data, valid, vmin, vmax, levels=65536, dtype=np.uint16)
+                    else:
+                        image_rows = render_valid(data, valid, 'gray' if gray_scale else colormap, vmin, vmax, alpha)
+                if export_format == 'png':
+                    with record.stage('encode'):
+                        png_writer.write_rows(image_rows)
+                else:
+                    with record.stage('transform'):
+                        image.paste(Image.fromarray(image_rows), (0, start - top))
+                if pyramid is not None:
+                    data[~valid] = np.nan
+                    pyramid.add_rows(data)
+                del rows, data, valid, image_rows
+
+            if export_format == 'png':
+                with record.stage('encode'):
+                    png_writer.close()
+                record.add('write', 0.0, png_writer.bytes_written)
+
+    if export_format != 'png':
+        encode_image(image_filename, image, 'jpeg' if export_format == 'jpg' else export_format, record)
+    if pyramid is not None:
+        pyramid.close()
+
+# Function to extract a single netCDF file to an image. With 'max_memory'
+# (bytes) the file is processed in strips of rows; scaling is skipped there
+# since it only resamples the image to its own size.
+def extract_image(nc_path, image_filename, export_format, gray_scale, apply_scaling, roi=None, array_store=None, colormap='viridis', png16=False, max_memory=None, tiles=None, record=None):
+    if record is None:
+        record = FileMetrics(os.path.basename(nc_path))
+
+    if max_memory:
+        return extract_image_strips(nc_path, image_filename, export_format, gray_scale, max_memory, roi, array_store, colormap, png16, tiles, record)
+
+    # netCDF4 is imported on first use so importing this module stays cheap
+    from netCDF4 import Dataset
+    with record.stage('read'):
+        with Dataset(nc_path, 'r') as dataset:
+            imagery_data = read_imagery_data(dataset, roi)
+    record.add('read', 0.0, imagery_data.nbytes)
+
+    # Apply scaling if specified
+    with record.stage('transform'):
+        if apply_scaling:
+            from PIL import Image
+            scaled_imagery_data = np.array(Image.fromarray(imagery_data).resize((imagery_data.shape[1], imagery_data.shape[0])))
+        else:
+            scaled_imagery_data = imagery_data
+
+    # Keep the raw array so later steps can skip netCDF decoding
+    if array_store is not None:
+        with record.stage('write', scaled_imagery_data.size * 4):
+            ArrayStore(array_store).write(*store_key(nc_path), scaled_imagery_data)
+
+    save_image(image_filename, scaled_imagery_data, export_format, cmap='gray' if gray_scale else colormap, png16=png16, record=record)
+
+    # Tile pyramid of the frame under <tiles>/<channel>/<scan start>
+    if tiles is not None:
+        write_tile_pyramid(get_frame_dir(tiles, nc_path), scaled_imagery_data, export_format, 'gray' if gray_scale else colormap, png16, record=record)
+
+# Worker entry point. Errors are returned rather than raised so one bad file
+# doesn't abort the rest of the batch. The file's metrics are returned as a
+# dict since the record can't be shared with the parent process.
+def process_file(task):
+    nc_path, image_filename, options = task
+    record = FileMetrics(os.path.basename(nc_path))
+    try:
+        extract_image(nc_path, image_filename, record=record, **options)
+    except Exception as e:
+        record.error = f"{type(e).__name__}: {e}"
+    return nc_path, record.error, record.as_dict()
+
+# Leave ctrl-c handling to the parent process
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Function to run extraction tasks serially or across a process pool. An
+# existing 'executor' can be passed in to reuse its warm worker processes
+# across batches; it is left running afterwards. Work is split into chunks
+# for 'workers' processes, so it should match the size of that pool.
+def run_tasks(tasks, workers, desc='Extracting Images', metrics=None, executor=None):
+    errors = []
+
+    owns_executor = False
+    if executor is None and workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        owns_executor = True
+
+    if executor is None:
+        results = map(process_file, tasks)
+    else:
+        # executor.map yields results in submission order, so progress stays ordered
+        results = executor.map(process_file, tasks, chunksize=max(1, len(tasks) // (max(1, workers) * 8)))
+
+    try:
+        for nc_path, error, file_metrics in tqdm(results, total=len(tasks), desc=desc, unit='file'):
+            if metrics is not None:
+                metrics.add(file_metrics)
+            if error is not None:
+                errors.append((nc_path, error))
+                tqdm.write(f"Error extracting {os.path.basename(nc_path)}: {error}")
+    finally:
+        if owns_executor:
+            executor.shutdown()
+
+    return errors
+
+# Function to extract every file of the selected channels in a data folder,
+# without prompting. Outputs go to 'output_data_dir' (default
+# 'extracted_data/<data folder>'): images in 'images/<channel>/', the array
+# store in 'arrays/' with 'save_arrays' and tile pyramids in 'tiles/' with
+# 'tiles'. Images already extracted from the same source file with the same
+# options are skipped unless 'force' is set. 'max_memory' (bytes per worker) switches to strip processing.
+# Returns (extracted image paths, number skipped, [(nc_path, error)]).
+def extract_directory(data_dir, channels, output_data_dir=None, export_format='jpg', gray_scale=False, apply_scaling=False, colormap='viridis', png16=False,
+                      workers=1, satellite=None, start=None, end=None, roi=None, save_arrays=False, tiles=False, max_memory=None, force=False, metrics=None, executor=None):
+    if png16 and export_format != 'png':
+        raise ValueError('16-bit output requires the png export format')
+
+    # List all netCDF files in the directory and index them by their filenames
+    file_list = [f for f in os.listdir(data_dir) if f.endswith('.nc')]
+    file_index = filter_files(index_files(file_list), satellite=satellite, start=start, end=end)
+    channel_files = group_by_channel(file_index, channels)
+
+    # Create a directory named after the data folder to store extracted data
+    if output_data_dir is None:
+        output_data_dir = os.path.join('extracted_data', os.path.basename(os.path.normpath(data_dir)))
+    output_images_dir = os.path.join(output_data_dir, 'images')
+    os.makedirs(output_images_dir, exist_ok=True)
+
+    # Options shared by every extraction task
+    options = {
+        'export_format': export_format,
+        'gray_scale': gray_scale,
+        'apply_scaling': apply_scaling,
+        'roi': roi,
+        'array_store': os.path.join(output_data_dir, 'arrays') if save_arrays else None,
+        'colormap': colormap,
+        'png16': png16,
+        'tiles': os.path.join(output_data_dir, 'tiles') if tiles else None,
+        'max_memory': max_memory,
+    }
+
+    # Images already extracted from the same source file with the same
+    # options are skipped. The memory cap only changes how an image is
+    # produced, so it isn't part of the hash.
+    extraction_index = ExtractionIndex(output_data_dir)
+    try:
+        recorded = {} if force else extraction_index.load()
+        options_hash = hash_options({key: value for key, value in options.items() if key != 'max_memory'})
+
+        # Build the list of extraction tasks for every selected channel
+        tasks = []
+        task_sources = {}
+        skipped = 0
+        for selected_channel_band_id, channel_file_list in channel_files.items():
+            channel_output_dir = os.path.join(output_images_dir, selected_channel_band_id)
+            os.makedirs(channel_output_dir, exist_ok=True)
+
+            for goes_file in channel_file_list:
+                # Get the original filename without extension
+                original_filename = os.path.splitext(goes_file.name)[0]
+                image_filename = os.path.join(channel_output_dir, f'image_{original_filename}.{export_format}')
+                nc_path = os.path.join(data_dir, goes_file.name)
+
+                source_stat = os.stat(nc_path)
+                if is_current(recorded, image_filename, source_stat, options_hash) and \
+                   (options['array_store'] is None or os.path.exists(ArrayStore(options['array_store']).path(*store_key(nc_path)))) and \
+                   (options['tiles'] is None or os.path.exists(os.path.join(get_frame_dir(options['tiles'], nc_path), METADATA_FILENAME))):
+                    skipped += 1
+                    continue
+
+                task_sources[nc_path] = (image_filename, source_stat)
+                tasks.append((nc_path, image_filename, options))
+
+        # Extract images from netCDF files and save them
+        errors = run_tasks(tasks, workers, metrics=metrics, executor=executor)
+
+        failed = {nc_path for nc_path, _ in errors}
+        extracted = [(image_filename, nc_path, source_stat, options_hash) for nc_path, (image_filename, source_stat) in task_sources.items() if nc_path not in failed]
+        extraction_index.record(extracted)
+    finally:
+        extraction_index.close()
+
+    return [entry[0] for entry in extracted], skipped, errors
+
+def main():
+    # Register ctrl-c handler
+    signal.signal(signal.SIGINT, signal_handler)
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Extract and process imagery data from netCDF files.')
+    parser.add_argument('data_dir', nargs='?', help='Directory containing netCDF files or network address')
+    parser.add_argument('selected_channel_band_ids', nargs='+', help='Selected channel identifiers (e.g., C01 C02 C03)')
+    parser.add_argument('--export_format', default='jpg', help='Export image format')
+    parser.add_argument('--gray_scale', action='store_true', help='Convert images to grayscale')
+    parser.add_argument('--apply_scaling', action='store_true', help='Apply scaling to images')
+    parser.add_argument('--colormap', default='viridis', help='Colormap used when not exporting in grayscale (default viridis)')
+    parser.add_argument('--png16', action='store_true', help='Export lossless 16-bit grayscale PNG images')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (default 1, serial)')
+    parser.add_argument('--satellite', help='Only extract files from this satellite (e.g., G16)')
+    parser.add_argument('--start', type=parse_time_argument, help='Only extract scans starting at or after this time (YYYY-MM-DDTHH:MM or YYYYJJJHHMM)')
+    parser.add_argument('--end', type=parse_time_argument, help='Only extract scans starting before this time (YYYY-MM-DDTHH:MM or YYYYJJJHHMM)')
+    parser.add_argument('--save_arrays', action='store_true', help="Also save the scaled CMI arrays to the memory-mapped array store in 'extracted_data/<data folder>/arrays'")
+    parser.add_argument('--tiles', action='store_true', help="Also write a 256x256 XYZ tile pyramid of each frame to 'extracted_data/<data folder>/tiles/<channel>/<scan start>'")
+    parser.add_argument('--max_memory', type=int, metavar='MB', help='Process each file in strips of rows using about this much memory per worker (MB) for png, e.g. for full disk C02 files; other formats also hold the whole image while encoding')
+    add_metrics_argument(parser)
+    parser.add_argument('--force', action='store_true', help='Extract every file, even if its image is up to date')
+    roi_group = parser.add_mutually_exclusive_group()
+    roi_group.add_argument('--roi', type=int, nargs=4, metavar=('TOP', 'BOTTOM', 'LEFT', 'RIGHT'), help='Only extract this pixel region of each file (top, bottom, left, right)')
+    roi_group.add_argument('--roi_latlon', type=float, nargs=4, metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'), help='Only extract the region covering this latitude/longitude box (degrees)')
+    args = parser.parse_args()
+
+    if args.png16 and args.export_format != 'png':
+        parser.error('--png16 requires --export_format png')
+    if args.max_memory and args.export_format.lower() != 'png':
+        print(f"Note: --max_memory only bounds the whole process for png. {args.export_format} images are encoded whole, "
+              f"which needs up to 4 bytes per pixel more plus the encoded file (about 2 GB per worker for full disk C02).")
+
+    # If data_dir is not specified, prompt the user to select a data folder
+    if not args.data_dir:
+        args.data_dir = select_data_directory()
+
+    if not os.path.isdir(args.data_dir):
+        print(f"Data directory '{args.data_dir}' not found. Please make sure it exists.")
+        exit(1)
+
+    # Region of interest to read from each file, if any
+    roi = None
+    if args.roi:
+        roi = ('pixels', tuple(args.roi))
+    elif args.roi_latlon:
+        roi = ('latlon', tuple(args.roi_latlon))
+
+    metrics = create_metrics('extract_img_data', args.metrics)
+    extracted, skipped, errors = extract_directory(args.data_dir, args.selected_channel_band_ids, export_format=args.export_format, gray_scale=args.gray_scale,
+                                                   apply_scaling=args.apply_scaling, colormap=args.colormap, png16=args.png16, workers=args.workers,
+                                                   satellite=args.satellite, start=args.start, end=args.end, roi=roi, save_arrays=args.save_arrays, tiles=args.tiles,
+                                                   max_memory=args.max_memory * 1024 * 1024 if args.max_memory else None, force=args.force, metrics=metrics)
+    if metrics is not None:
+        metrics.close()
+
+    if skipped:
+        print(f"Skipped {skipped} files already extracted with the same options (use --force to extract them again).")
+    if errors:
+        print(f"{len(errors)} of {len(extracted) + len(errors)} files failed to extract.")
+    print('Extracted images saved successfully.')
 
-print('Extracted images saved successfully.')
+if __name__ == "__main__":
+    main()
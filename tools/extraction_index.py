@@ -0,0 +1,69 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# Index of the images written by the extractor, stored as SQLite in the
+# output folder. Each output is recorded with the size and mtime of the
+# netCDF file it came from and a hash of the processing options, so a re-run
+# only has to stat() files to know which outputs are still up to date.
+
+INDEX_FILENAME = '.extraction_index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outputs (
+    output TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    source_size INTEGER NOT NULL,
+    source_mtime_ns INTEGER NOT NULL,
+    options_hash TEXT NOT NULL,
+    output_size INTEGER NOT NULL,
+    extracted_at REAL NOT NULL
+)
+'''
+
+# Function to hash the options that affect an extracted image
+def hash_options(options):
+    encoded = json.dumps(options, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+class ExtractionIndex:
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, INDEX_FILENAME)
+        os.makedirs(output_dir, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    # Function to load every recorded output at once; a per-file query is
+    # slower than one scan for folders of thousands of files
+    def load(self):
+        rows = self.connection.execute('SELECT output, source_size, source_mtime_ns, options_hash, output_size FROM outputs')
+        return {row[0]: row[1:] for row in rows}
+
+    # Function to record outputs written successfully. 'entries' holds
+    # (output, source, source_stat, options_hash) tuples.
+    def record(self, entries):
+        rows = []
+        for output, source, source_stat, options_hash in entries:
+            rows.append((output, source, source_stat.st_size, source_stat.st_mtime_ns, options_hash, os.path.getsize(output), time.time()))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+# Function to check whether an output is up to date with its source file and
+# the current options, using the rows returned by ExtractionIndex.load()
+def is_current(recorded, output, source_stat, options_hash):
+    row = recorded.get(output)
+    if row is None:
+        return False
+    source_size, source_mtime_ns, recorded_hash, output_size = row
+    if (source_size, source_mtime_ns, recorded_hash) != (source_stat.st_size, source_stat.st_mtime_ns, options_hash):
+        return False
+    try:
+        return os.path.getsize(output) == output_size
+    except FileNotFoundError:
+        return False
@@ -1,37 +1,125 @@
 import os
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 import concurrent.futures
+import threading
 import time
+from .manifest import Manifest, CORRUPT
+from .metrics import track, add_metrics_argument, create_metrics
 
-def download_file(url, save_path):
-    response = requests.get(url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
-    
-    if os.path.exists(save_path):
-        local_size = os.path.getsize(save_path)
-        if local_size == total_size:
-            print(f"Skipping {os.path.basename(url)} - already downloaded.")
-            return
-    
-    with open(save_path, 'wb') as f:
-        with tqdm(
-            desc=os.path.basename(url),
-            total=total_size,
-            unit='B',
-            unit_scale=True,
-            unit_divisor=1024,
-            ncols=150,
-            ascii=True,
-        ) as pbar:
-            for data in response.iter_content(chunk_size=8192):
-                f.write(data)
-                pbar.update(len(data))
-
-def download_files(urls, save_folder, max_workers):
+CHUNK_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = (10, 60)
+
+# Each worker thread keeps its own keep-alive session so connections (and TLS
+# handshakes) are reused across every file that thread downloads.
+thread_local = threading.local()
+
+def create_session(pool_size=1):
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_session():
+    session = getattr(thread_local, 'session', None)
+    if session is None:
+        session = create_session()
+        thread_local.session = session
+    return session
+
+# Function to get the remote size and validator of a file without downloading it.
+# Returns (size, validator), either of which may be None if the server doesn't say.
+def get_remote_info(session, url):
+    response = session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code >= 400:
+        return None, None
+
+    size = response.headers.get('content-length')
+    size = int(size) if size is not None else None
+
+    # Only strong ETags can be used with If-Range
+    validator = response.headers.get('ETag')
+    if validator is None or validator.startswith('W/'):
+        validator = response.headers.get('Last-Modified')
+    return size, validator
+
+def get_part_path(save_path):
+    return save_path + '.part'
+
+def download_file(url, save_path, session=None, manifest=None, metrics=None):
+    with track(metrics, os.path.basename(url)) as record:
+        if session is None:
+            session = get_session()
+
+        with record.stage('network'):
+            total_size, validator = get_remote_info(session, url)
+        if manifest is not None:
+            manifest.record_remote(os.path.basename(url), total_size, validator)
+
+        if os.path.exists(save_path):
+            local_size = os.path.getsize(save_path)
+            if local_size == total_size:
+                print(f"Skipping {os.path.basename(url)} - already downloaded.")
+                if manifest is not None:
+                    manifest.mark_complete(os.path.basename(url), total_size, validator)
+                return
+
+        # Resume from a previous partial download if there is one
+        part_path = get_part_path(save_path)
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if total_size is not None and resume_from > total_size:
+            resume_from = 0
+
+        if total_size is None or resume_from < total_size:
+            headers = {}
+            if resume_from:
+                headers['Range'] = f'bytes={resume_from}-'
+                if validator:
+                    # If the file changed on the server we get the whole new file back
+                    headers['If-Range'] = validator
+
+            with record.stage('network'):
+                response = session.get(url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT)
+            with response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    resume_from = 0
+                    if total_size is None and 'content-length' in response.headers:
+                        total_size = int(response.headers['content-length'])
+
+                with open(part_path, 'ab' if resume_from else 'wb') as f:
+                    with tqdm(
+                        desc=os.path.basename(url),
+                        total=total_size,
+                        initial=resume_from,
+                        unit='B',
+                        unit_scale=True,
+                        unit_divisor=1024,
+                        ncols=150,
+                        ascii=True,
+                    ) as pbar:
+                        for data in record.timed(response.iter_content(chunk_size=CHUNK_SIZE)):
+                            with record.stage('write', len(data)):
+                                f.write(data)
+                            pbar.update(len(data))
+
+        # Keep the partial file for the next run if the transfer was cut short
+        part_size = os.path.getsize(part_path)
+        if total_size is not None and part_size != total_size:
+            raise IOError(f"incomplete download ({part_size} of {total_size} bytes), will resume on next run")
+
+        os.replace(part_path, save_path)
+        if manifest is not None:
+            manifest.mark_complete(os.path.basename(url), total_size, validator)
+
+def download_files(urls, save_folder, max_workers, manifest=None, metrics=None):
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_url = {executor.submit(download_file, url, os.path.join(save_folder, os.path.basename(url))): url for url in urls}
+        future_to_url = {executor.submit(download_file, url, os.path.join(save_folder, os.path.basename(url)), manifest=manifest, metrics=metrics): url for url in urls}
         
         with tqdm(total=len(future_to_url), desc="Overall Progress", ncols=100, ascii=True) as overall_pbar:
             for future in concurrent.futures.as_completed(future_to_url):
@@ -50,50 +138,113 @@ def list_available_sources(source_folder):
             available_sources.append(filename)
     return available_sources
 
+# Function to prompt for a data source file. Returns None if the selection is invalid.
+def select_source_file():
+    script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the script
+    source_folder = os.path.join(script_dir, '..', 'data_sources')  # Navigate to the parent directory and then 'data_sources'
+    available_sources = list_available_sources(source_folder)
+    if available_sources:
+        print("\nAvailable data source files:\n")
+        for idx, source in enumerate(available_sources, start=1):
+            print(f"{idx}. {source}")
+        source_index = int(input("\nSelect a source file (1, 2, ...): ")) - 1
+        if source_index >= 0 and source_index < len(available_sources):
+            return os.path.join(source_folder, available_sources[source_index])
+        print("Invalid selection. Exiting.")
+        return None
+    print("\nNo valid data source files found in the '../data_sources/' folder.")
+    return input("Enter the path to a data source file: ")
+
+# Function to read the URLs of a data source file, skipping blank lines
+def read_source_urls(input_file_path):
+    with open(input_file_path, 'r', encoding='utf-8') as input_file:
+        return [line.strip() for line in input_file if line.strip()]
+
+# Function to get the folder a data source file is downloaded to
+def get_save_path(input_file_path, data_folder='data'):
+    save_folder_name = os.path.splitext(os.path.basename(input_file_path))[0]
+    return os.path.join(data_folder, save_folder_name)
+
+# Function to bring the manifest of a download folder up to date and return
+# the URLs that still need fetching. Only local stat() calls are made; files
+# flagged corrupt are removed so they're downloaded again from scratch.
+def get_pending_urls(manifest, urls):
+    manifest.add_urls(urls)
+    manifest.refresh()
+
+    for row in manifest.rows(states=(CORRUPT,)):
+        for path in (os.path.join(manifest.data_dir, row['name']), get_part_path(os.path.join(manifest.data_dir, row['name']))):
+            if os.path.exists(path):
+                os.remove(path)
+
+    pending = set(manifest.pending_urls())
+    return [url for url in urls if url in pending]
+
+# Function to download the files of a data source file to
+# 'data/<source name>/', without prompting. Files the manifest already knows
+# to be complete are skipped without touching the network. Returns the URLs
+# that were fetched and those that are still missing afterwards.
+def download_source(input_file_path, data_folder='data', max_workers=20, engine='threads', metrics=None):
+    urls = read_source_urls(input_file_path)
+    save_path = get_save_path(input_file_path, data_folder)
+    os.makedirs(save_path, exist_ok=True)
+
+    manifest = Manifest(save_path)
+    try:
+        pending_urls = get_pending_urls(manifest, urls)
+        if len(pending_urls) < len(urls):
+            print(f"{len(urls) - len(pending_urls)} of {len(urls)} files already downloaded, {len(pending_urls)} to fetch.")
+
+        if not pending_urls:
+            print("Nothing to download.")
+        elif engine == 'async':
+            from .async_download import download_files_async, print_host_summary
+            host_summary, errors = download_files_async(pending_urls, save_path, max_workers, manifest=manifest, metrics=metrics)
+            print_host_summary(host_summary)
+        else:
+            download_files(pending_urls, save_path, max_workers, manifest=manifest, metrics=metrics)
+    finally:
+        manifest.close()
+
+    missing_urls = [url for url in pending_urls if not os.path.exists(os.path.join(save_path, os.path.basename(url)))]
+    return pending_urls, missing_urls
+
 def main():
     try:
         parser = argparse.ArgumentParser(description='Download files from a list of URLs.')
         parser.add_argument('input_file_path', nargs='?', default='', help='Path to the input file containing URLs. (default is ../data/)')
         parser.add_argument('--max_workers', type=int, default=20, help='Number of concurrent downloads.')
+        add_metrics_argument(parser)
+        parser.add_argument('--engine', choices=['threads', 'async'], default='threads', help='Download engine. The async engine adapts the number of concurrent downloads (up to --max_workers) to throughput and throttling.')
         args = parser.parse_args()
     
         if not args.input_file_path:
-            script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the script
-            source_folder = os.path.join(script_dir, '..', 'data_sources')  # Navigate to the parent directory and then 'data_sources'
-            available_sources = list_available_sources(source_folder)
-            if available_sources:
-                print("\nAvailable data source files:\n")
-                for idx, source in enumerate(available_sources, start=1):
-                    print(f"{idx}. {source}")
-                source_index = int(input("\nSelect a source file (1, 2, ...): ")) - 1
-                if source_index >= 0 and source_index < len(available_sources):
-                    args.input_file_path = os.path.join(source_folder, available_sources[source_index])
-                else:
-                    print("Invalid selection. Exiting.")
-                    return
-            else:
-                print("\nNo valid data source files found in the '../data_sources/' folder.")
-                args.input_file_path = input("Enter the path to a data source file: ")
-        
-        with open(args.input_file_path, 'r', encoding='utf-8') as input_file:
-            urls = [line.strip() for line in input_file]
-
-        save_folder_name = os.path.splitext(os.path.basename(args.input_file_path))[0]
-        data_folder = 'data'
-        os.makedirs(data_folder, exist_ok=True)
-        save_path = os.path.join(data_folder, save_folder_name)
-        os.makedirs(save_path, exist_ok=True)
+            args.input_file_path = select_source_file()
+            if args.input_file_path is None:
+                return
         
+        save_path = get_save_path(args.input_file_path)
         start_time = time.time()
 
-        download_files(urls, save_path, args.max_workers)
+        metrics = create_metrics('get_data', args.metrics)
+        try:
+            pending_urls, missing_urls = download_source(args.input_file_path, max_workers=args.max_workers, engine=args.engine, metrics=metrics)
+        except ImportError as e:
+            print(e)
+            exit(1)
+        finally:
+            if metrics is not None:
+                metrics.close()
                 
-        total_size = sum(os.path.getsize(os.path.join(save_path, os.path.basename(url))) for url in urls)
+        downloaded_files = [os.path.join(save_path, os.path.basename(url)) for url in pending_urls]
+        total_size = sum(os.path.getsize(path) for path in downloaded_files if os.path.exists(path))
         total_time = time.time() - start_time
         average_speed = total_size / total_time / (1024 * 1024)
         
         print(f"Total downloaded: {total_size / (1024 * 1024):.2f} MB")
-        print(f"Average download speed: {average_speed:.2f} Mb/s")
+        print(f"Average download speed: {average_speed:.2f} MB/s")
+        if missing_urls:
+            print(f"{len(missing_urls)} of {len(pending_urls)} files could not be downloaded.")
         
     except KeyboardInterrupt:
         print("\nProgram interrupted. Exiting...")
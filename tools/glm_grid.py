@@ -0,0 +1,217 @@
+import os
+import signal
+import argparse
+import concurrent.futures
+from collections import namedtuple
+from datetime import datetime, timedelta
+import numpy as np
+from netCDF4 import Dataset
+from tqdm import tqdm
+from .goes_files import index_files, filter_files, format_goes_time, parse_time_argument
+from .goes_projection import latlon_to_scan_angles
+from .array_store import ArrayStore
+from .colormap import save_image
+from .extract_img_data import select_data_directory, signal_handler, init_worker
+
+# GLM Lightning Cluster-Filter Algorithm (LCFA) files hold ~20 s of flashes,
+# groups and events as flat lat/lon/energy arrays. They are binned onto the
+# ABI full disk fixed grid, so the density grids cover exactly the same area
+# as full disk ABI imagery and can be cropped and blended with it.
+
+GLM_KINDS = ('flash', 'group', 'event')
+
+# Edge of the ABI full disk fixed grid in radians (half a 2 km pixel beyond
+# the outermost pixel centre at 0.151844 rad)
+FULL_DISK_EDGE = 0.151872
+
+# Default sub-satellite longitudes, used if a file doesn't carry its own
+SATELLITE_LONGITUDES = {'G16': -75.0, 'G17': -137.0, 'G18': -137.0, 'G19': -75.0}
+
+GRS80_PROJECTION = {
+    'semi_major_axis': 6378137.0,
+    'semi_minor_axis': 6356752.31414,
+    'perspective_point_height': 35786023.0,
+}
+
+GlmGrid = namedtuple('GlmGrid', ['size', 'scale'])
+
+# Function to define a full disk grid at a resolution in km (2 km = 5424 px)
+def make_grid(resolution_km):
+    size = int(round(5424 * 2 / resolution_km))
+    return GlmGrid(size=size, scale=2 * FULL_DISK_EDGE / size)
+
+# Function to read one LCFA file and bin its points to flat grid indices.
+# Returns {kind: (indices, weights)} with weights None when counting.
+def read_glm_file(nc_path, kinds, weight, grid, satellite):
+    binned = {}
+    with Dataset(nc_path, 'r') as dataset:
+        if 'nominal_satellite_subpoint_lon' in dataset.variables:
+            lon_0 = float(dataset.variables['nominal_satellite_subpoint_lon'][:])
+        else:
+            lon_0 = SATELLITE_LONGITUDES.get(satellite, -75.0)
+        projection = dict(GRS80_PROJECTION, longitude_of_projection_origin=lon_0)
+
+        for kind in kinds:
+            lat = np.ma.filled(dataset.variables[f'{kind}_lat'][:].astype(np.float64), np.nan)
+            lon = np.ma.filled(dataset.variables[f'{kind}_lon'][:].astype(np.float64), np.nan)
+            weights = np.ma.filled(dataset.variables[f'{kind}_energy'][:].astype(np.float64), 0.0) if weight == 'energy' else None
+
+            x, y, visible = latlon_to_scan_angles(lat, lon, projection)
+
+            # Columns run west to east (+x), rows north to south (-y)
+            col = np.floor((x + FULL_DISK_EDGE) / grid.scale)
+            row = np.floor((FULL_DISK_EDGE - y) / grid.scale)
+            keep = visible & np.isfinite(col) & np.isfinite(row) & (col >= 0) & (col < grid.size) & (row >= 0) & (row < grid.size)
+
+            indices = (row[keep].astype(np.int64) * grid.size + col[keep].astype(np.int64))
+            binned[kind] = (indices, weights[keep] if weights is not None else None)
+    return binned
+
+# Worker entry point, returning errors instead of raising them
+def process_glm_file(task):
+    nc_path, kinds, weight, grid, satellite = task
+    try:
+        return nc_path, read_glm_file(nc_path, kinds, weight, grid, satellite), None
+    except Exception as e:
+        return nc_path, None, f"{type(e).__name__}: {e}"
+
+# Function to get the start of the accumulation window containing 'time'.
+# Windows are aligned to the clock (e.g. :00, :05, :10 for 5 minutes).
+def window_start(time, window):
+    midnight = datetime(time.year, time.month, time.day)
+    return time - (time - midnight) % window
+
+# Accumulates binned points for one window and turns them into a grid
+class WindowAccumulator:
+    def __init__(self, grid, kinds):
+        self.grid = grid
+        self.kinds = kinds
+        self.reset()
+
+    def reset(self):
+        self.indices = {kind: [] for kind in self.kinds}
+        self.weights = {kind: [] for kind in self.kinds}
+        self.files = 0
+
+    def add(self, binned):
+        for kind, (indices, weights) in binned.items():
+            self.indices[kind].append(indices)
+            if weights is not None:
+                self.weights[kind].append(weights)
+        self.files += 1
+
+    # Histogram all points of the window at once with np.bincount
+    def density(self, kind):
+        cells = self.grid.size * self.grid.size
+        if not self.indices[kind]:
+            return np.zeros((self.grid.size, self.grid.size), dtype=np.float32)
+        indices = np.concatenate(self.indices[kind])
+        weights = np.concatenate(self.weights[kind]) if self.weights[kind] else None
+        return np.bincount(indices, weights=weights, minlength=cells).astype(np.float32).reshape(self.grid.size, self.grid.size)
+
+# Function to write the grids of one window as images and/or arrays
+def write_window(accumulator, start, args, images_dir, store):
+    key = format_goes_time(start)
+    for kind in accumulator.kinds:
+        density = accumulator.density(kind)
+        channel = f'GLM_{kind}'
+
+        if store is not None:
+            store.write(channel, key, density)
+
+        if images_dir is not None:
+            channel_dir = os.path.join(images_dir, channel)
+            os.makedirs(channel_dir, exist_ok=True)
+            # Empty cells are masked so they come out transparent when overlaid
+            image_filename = os.path.join(channel_dir, f'image_{channel}_s{key}.{args.export_format}')
+            save_image(image_filename, np.ma.masked_equal(density, 0), args.export_format, cmap='gray' if args.gray_scale else args.colormap)
+
+def main():
+    signal.signal(signal.SIGINT, signal_handler)
+
+    parser = argparse.ArgumentParser(description='Aggregate GLM lightning (LCFA) files into density grids on the ABI full disk fixed grid.')
+    parser.add_argument('data_dir', nargs='?', help='Directory containing GLM LCFA netCDF files')
+    parser.add_argument('--kinds', nargs='+', choices=GLM_KINDS, default=['flash'], help='Point types to grid (default flash)')
+    parser.add_argument('--weight', choices=['count', 'energy'], default='count', help='Count points or sum their energy (default count)')
+    parser.add_argument('--window', type=float, default=5, help='Accumulation window in minutes (default 5)')
+    parser.add_argument('--resolution', type=float, default=8, help='Grid resolution in km at the sub-satellite point (default 8; ABI is 0.5-2)')
+    parser.add_argument('--export_format', default='png', help='Export image format (default png)')
+    parser.add_argument('--gray_scale', action='store_true', help='Export grayscale images')
+    parser.add_argument('--colormap', default='inferno', help='Colormap used when not exporting in grayscale (default inferno)')
+    parser.add_argument('--save_arrays', action='store_true', help="Save the density grids to the array store in 'extracted_data/<data folder>/arrays'")
+    parser.add_argument('--no_images', action='store_true', help='Only save the array store, no images')
+    parser.add_argument('--satellite', help='Only use files from this satellite (e.g., G16)')
+    parser.add_argument('--start', type=parse_time_argument, help='Only use files starting at or after this time (YYYY-MM-DDTHH:MM or YYYYJJJHHMM)')
+    parser.add_argument('--end', type=parse_time_argument, help='Only use files starting before this time (YYYY-MM-DDTHH:MM or YYYYJJJHHMM)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes reading files (default 1, serial)')
+    args = parser.parse_args()
+
+    if args.no_images and not args.save_arrays:
+        parser.error('--no_images requires --save_arrays')
+
+    if not args.data_dir:
+        args.data_dir = select_data_directory()
+
+    try:
+        file_list = [f for f in os.listdir(args.data_dir) if f.endswith('.nc')]
+    except FileNotFoundError:
+        print(f"Data directory '{args.data_dir}' not found. Please make sure it exists.")
+        exit(1)
+
+    glm_files = list(filter_files(index_files(file_list), satellite=args.satellite, start=args.start, end=args.end, products={'GLM-L2-LCFA'}))
+    if not glm_files:
+        print(f"No GLM LCFA files found in '{args.data_dir}'.")
+        exit(1)
+
+    parent_folder_name = os.path.basename(os.path.normpath(args.data_dir))
+    output_data_dir = os.path.join('extracted_data', parent_folder_name)
+    images_dir = None if args.no_images else os.path.join(output_data_dir, 'images')
+    store = ArrayStore(os.path.join(output_data_dir, 'arrays')) if args.save_arrays else None
+
+    grid = make_grid(args.resolution)
+    window = timedelta(minutes=args.window)
+    tasks = [(os.path.join(args.data_dir, f.name), args.kinds, args.weight, grid, f.satellite) for f in glm_files]
+
+    if args.workers <= 1:
+        executor = None
+        results = map(process_glm_file, tasks)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker)
+        results = executor.map(process_glm_file, tasks, chunksize=4)
+
+    # Files arrive in time order, so each window is written as soon as the
+    # first file of the next window shows up and only one window is held
+    accumulator = WindowAccumulator(grid, args.kinds)
+    current_window = None
+    windows_written = 0
+    errors = 0
+
+    try:
+        # The results come first so they are run to the end before zip stops
+        for (nc_path, binned, error), glm_file in tqdm(zip(results, glm_files), total=len(tasks), desc='Gridding GLM', unit='file'):
+            file_window = window_start(glm_file.start, window)
+            if current_window is not None and file_window != current_window:
+                write_window(accumulator, current_window, args, images_dir, store)
+                windows_written += 1
+                accumulator.reset()
+            current_window = file_window
+
+            if error is not None:
+                errors += 1
+                tqdm.write(f"Error reading {os.path.basename(nc_path)}: {error}")
+                continue
+            accumulator.add(binned)
+
+        if current_window is not None:
+            write_window(accumulator, current_window, args, images_dir, store)
+            windows_written += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if errors:
+        print(f"{errors} of {len(tasks)} files could not be read.")
+    print(f"{windows_written} windows of {args.window:g} minutes gridded at {args.resolution:g} km ({grid.size}x{grid.size}).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# GOES-R product filenames follow the convention
+#   OR_<product>[-M<mode><channel>]_<satellite>_s<start>_e<end>_c<created>.nc
+# e.g. OR_ABI-L2-CMIPF-M6C01_G16_s20231570700214_e20231570709522_c20231570709590.nc
+#      OR_GLM-L2-LCFA_G16_s20231570559400_e20231570600000_c20231570600022.nc
+# Timestamps are YYYYJJJHHMMSSt (year, day of year, time, tenths of a second).
+GOES_FILENAME_PATTERN = re.compile(
+    r'OR_(?P<product>[A-Za-z0-9-]+?)'
+    r'(?:-M(?P<scan_mode>\d)(?P<channel>C\d{2})?)?'
+    r'_(?P<satellite>G\d{2})'
+    r'_s(?P<start>\d{14})'
+    r'_e(?P<end>\d{14})'
+    r'_c(?P<created>\d{14})'
+)
+
+# Scan start stamp on its own, e.g. 'image_C01_s20231570700214.jpg' written
+# from the array store
+SCAN_START_PATTERN = re.compile(r'(?:^|_)s(?P<start>\d{14})(?:[_.]|$)')
+
+GoesFile = namedtuple('GoesFile', ['name', 'product', 'scan_mode', 'channel', 'satellite', 'start', 'end', 'created'])
+
+# Function to convert a GOES-R filename timestamp to a datetime
+def parse_goes_time(timestamp):
+    return datetime.strptime(timestamp[:13], '%Y%j%H%M%S') + timedelta(milliseconds=100 * int(timestamp[13]))
+
+# Function to format a datetime as a GOES-R filename timestamp
+def format_goes_time(time):
+    return time.strftime('%Y%j%H%M%S') + str(time.microsecond // 100000)
+
+# Function to parse a GOES-R filename. Any prefix or extension around the
+# product name (e.g. 'image_OR_ABI-...jpg') is ignored. Returns None if the
+# name doesn't follow the convention.
+def parse_goes_filename(name):
+    match = GOES_FILENAME_PATTERN.search(os.path.basename(name))
+    if match is None:
+        return None
+
+    return GoesFile(
+        name=name,
+        product=match.group('product'),
+        scan_mode=f"M{match.group('scan_mode')}" if match.group('scan_mode') else None,
+        channel=match.group('channel'),
+        satellite=match.group('satellite'),
+        start=parse_goes_time(match.group('start')),
+        end=parse_goes_time(match.group('end')),
+        created=parse_goes_time(match.group('created')),
+    )
+
+# Function to get the scan start time of a file from its name, or None
+def parse_scan_start(name):
+    goes_file = parse_goes_filename(name)
+    if goes_file is not None:
+        return goes_file.start
+
+    match = SCAN_START_PATTERN.search(os.path.basename(name))
+    return parse_goes_time(match.group('start')) if match else None
+
+# Function to parse a list of filenames into GoesFile records sorted by scan
+# start time. Names that don't follow the convention are dropped.
+def index_files(file_names):
+    parsed = (parse_goes_filename(name) for name in file_names)
+    return sorted((f for f in parsed if f is not None), key=lambda f: (f.start, f.name))
+
+# Function to filter indexed files by satellite and scan start time range
+def filter_files(files, satellite=None, start=None, end=None, products=None):
+    for f in files:
+        if satellite is not None and f.satellite != satellite:
+            continue
+        if start is not None and f.start < start:
+            continue
+        if end is not None and f.start >= end:
+            continue
+        if products is not None and f.product not in products:
+            continue
+        yield f
+
+# Function to dispatch indexed files into per-channel buckets in a single pass.
+# Only the requested channels are kept when 'channels' is given.
+def group_by_channel(files, channels=None):
+    buckets = {channel: [] for channel in channels} if channels is not None else {}
+    for f in files:
+        if f.channel is None:
+            continue
+        if channels is None:
+            buckets.setdefault(f.channel, []).append(f)
+        elif f.channel in buckets:
+            buckets[f.channel].append(f)
+    return buckets
+
+# Function to parse a command line time argument. Accepts ISO 8601
+# ('2023-06-06T07:00') or GOES-R day-of-year form ('20231570700').
+def parse_time_argument(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+
+    digits = value.lstrip('s')
+    for fmt in ('%Y%j%H%M%S', '%Y%j%H%M', '%Y%j'):
+        try:
+            return datetime.strptime(digits, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognized time '{value}'. Use YYYY-MM-DDTHH:MM or YYYYJJJHHMM.")
@@ -0,0 +1,68 @@
+import numpy as np
+
+# GOES-R ABI fixed grid projection helpers (GOES-R Product User's Guide,
+# section 5.1.2.8). Pixel positions in ABI files are given as 'x'/'y' scan
+# angles in radians as seen from the satellite.
+
+# Function to read the projection parameters from a netCDF dataset
+def read_projection(dataset):
+    projection = dataset.variables['goes_imager_projection']
+    return {
+        'semi_major_axis': float(projection.semi_major_axis),
+        'semi_minor_axis': float(projection.semi_minor_axis),
+        'perspective_point_height': float(projection.perspective_point_height),
+        'longitude_of_projection_origin': float(projection.longitude_of_projection_origin),
+    }
+
+# Function to convert latitude/longitude (degrees) to fixed grid scan angles.
+# Returns x, y (radians) and a mask of the points visible from the satellite.
+def latlon_to_scan_angles(lat, lon, projection):
+    r_eq = projection['semi_major_axis']
+    r_pol = projection['semi_minor_axis']
+    height = projection['perspective_point_height'] + r_eq
+    lon_0 = np.radians(projection['longitude_of_projection_origin'])
+
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+
+    eccentricity_sq = (r_eq ** 2 - r_pol ** 2) / r_eq ** 2
+    lat_c = np.arctan((r_pol ** 2 / r_eq ** 2) * np.tan(lat))
+    r_c = r_pol / np.sqrt(1 - eccentricity_sq * np.cos(lat_c) ** 2)
+
+    s_x = height - r_c * np.cos(lat_c) * np.cos(lon - lon_0)
+    s_y = -r_c * np.cos(lat_c) * np.sin(lon - lon_0)
+    s_z = r_c * np.sin(lat_c)
+
+    visible = height * (height - s_x) >= s_y ** 2 + (r_eq ** 2 / r_pol ** 2) * s_z ** 2
+    x = np.arcsin(-s_y / np.sqrt(s_x ** 2 + s_y ** 2 + s_z ** 2))
+    y = np.arctan(s_z / s_x)
+    return x, y, visible
+
+# Function to find the pixel bounds (top, bottom, left, right) covering a
+# latitude/longitude box on a file's fixed grid. Only the 1-D 'x' and 'y'
+# coordinate variables are read.
+def latlon_box_to_pixels(dataset, lat_min, lat_max, lon_min, lon_max, samples=64):
+    projection = read_projection(dataset)
+
+    # Sample the whole box, not just its corners, since the grid is curved
+    lat, lon = np.meshgrid(np.linspace(lat_min, lat_max, samples), np.linspace(lon_min, lon_max, samples))
+    x, y, visible = latlon_to_scan_angles(lat, lon, projection)
+    if not visible.any():
+        raise ValueError(f"region {lat_min}..{lat_max} lat, {lon_min}..{lon_max} lon is not visible from this satellite")
+    x, y = x[visible], y[visible]
+
+    x_coords = dataset.variables['x'][:]
+    y_coords = dataset.variables['y'][:]
+
+    # x increases left to right, y decreases top to bottom
+    left = np.searchsorted(x_coords, x.min(), side='left')
+    right = np.searchsorted(x_coords, x.max(), side='right')
+    top = np.searchsorted(-y_coords, -y.max(), side='left')
+    bottom = np.searchsorted(-y_coords, -y.min(), side='right')
+
+    return (
+        int(max(0, top - 1)),
+        int(min(len(y_coords), bottom + 1)),
+        int(max(0, left - 1)),
+        int(min(len(x_coords), right + 1)),
+    )
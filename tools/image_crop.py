@@ -1,9 +1,13 @@
 import os
-import cv2
+import numpy as np
 from tqdm import tqdm
 import time
 import shutil
 import argparse
+import concurrent.futures
+from .array_store import ArrayStore
+from .colormap import render_image
+from .metrics import track, add_metrics_argument, create_metrics
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Image cropping and resizing script.")
@@ -11,6 +15,13 @@ def parse_args():
     parser.add_argument("--export_format", default="jpg", help="Export image format.")
     parser.add_argument("--resize_resolution", type=int, nargs=2, default=[2400, 2400], help="Resize resolution (width height).")
     parser.add_argument("--crop_area", type=int, nargs=4, default=[50, 450, 900, 1500], help="Crop area (top, bottom, left, right).")
+    parser.add_argument("--single_pass", action="store_true", help="Resize and crop each image in one in-memory pass, encoding it only once.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker threads used with --single_pass or --array_store.")
+    parser.add_argument("--array_store", help="Crop raw arrays from this array store (e.g. extracted_data/<order>/arrays) instead of images.")
+    parser.add_argument("--channels", nargs="*", help="Channels to crop from the array store (default: all).")
+    parser.add_argument("--gray_scale", action="store_true", help="Render arrays from the array store in grayscale.")
+    parser.add_argument("--colormap", default="viridis", help="Colormap used to render arrays from the array store when not in grayscale (default viridis).")
+    add_metrics_argument(parser)
     return parser.parse_args()
 
 def get_script_directory():
@@ -49,85 +60,230 @@ def select_channels(extracted_data_dir):
     return selected_dirs
 
 def create_output_subdirectories(output_base_dir, input_sub_dir):
-    # Recreate the subdirectory structure under the output base directory.
-    subdirs = os.path.relpath(input_sub_dir, extracted_data_dir)
+    # Recreate the '<order>/images/<channel>' structure under the output base directory.
+    subdirs = os.path.join(*os.path.normpath(input_sub_dir).split(os.sep)[-3:])
     output_sub_dir = os.path.join(output_base_dir, subdirs)
     create_directory(output_sub_dir)
     return output_sub_dir
 
-args = parse_args()
-
-if args.input_image_dirs is None:
-    script_dir = get_script_directory()
-    extracted_data_dir = os.path.join(script_dir, "..", "extracted_data")
-    # Get the relative paths from extracted_data_dir
-    selected_dirs = select_channels(extracted_data_dir)
-    cropped_channel_dir = [os.path.relpath(dir_path, extracted_data_dir) for dir_path in selected_dirs]
-else:
-    selected_dirs = args.input_image_dirs
-    cropped_channel_dir = selected_dirs
-
-output_channel_names = "_".join([os.path.basename(os.path.dirname(dir_path)) for dir_path in cropped_channel_dir])
-export_format = args.export_format
-resize_resolution = tuple(args.resize_resolution)
-crop_area = tuple(args.crop_area)
-
-output_dirs = []
-cropped_images_dir = os.path.join(get_script_directory(), "..", "cropped_images")
-create_directory(cropped_images_dir)
-
-for dir_path in cropped_channel_dir:
-    output_base_dir = os.path.join(cropped_images_dir, os.path.basename(dir_path))
-
-    output_sub_dir = create_output_subdirectories(output_base_dir, dir_path)
-    output_dirs.append(output_sub_dir)
-
-num_images = int(sum(len(os.listdir(dir_path)) for dir_path in selected_dirs) / 2)
-
-progress_bar = tqdm(total=num_images, desc="Resizing Images", unit="image")
-start_time = time.time()
-
-for dir_path, output_dir in zip(selected_dirs, output_dirs):
-    for frame, image_file in enumerate(sorted(os.listdir(dir_path))):
-        if image_file.endswith("." + export_format):
-            image_path = os.path.join(dir_path, image_file)
-            image = cv2.imread(image_path)
-            if image is None:
-                continue  # Skip non-image files
-            resized_image = cv2.resize(image, resize_resolution)
-            temp_image_path = os.path.join(output_dir, image_file)
-            cv2.imwrite(temp_image_path, resized_image)
-            progress_bar.update(1)
+# Function to resize and crop an image in one pass. The crop area is given in
+# resized coordinates; it is mapped back onto the source image and only that
+# region is resampled, giving the same result as cv2.resize followed by slicing.
+def resize_and_crop_image(image, resize_resolution, crop_area):
+    # OpenCV is imported on first use so importing this module stays cheap
+    import cv2
+
+    height, width = image.shape[:2]
+    resize_width, resize_height = resize_resolution
+    top, bottom, left, right = crop_area
+
+    # Clamp the crop area to the resized image like slicing would
+    top, bottom = max(0, min(top, resize_height)), max(0, min(bottom, resize_height))
+    left, right = max(0, min(left, resize_width)), max(0, min(right, resize_width))
+    if bottom <= top or right <= left:
+        return image[:0, :0]
+
+    # Source region needed to interpolate the crop area, plus a pixel of margin
+    scale_x = width / resize_width
+    scale_y = height / resize_height
+    x0 = max(0, int(np.floor((left + 0.5) * scale_x - 0.5)) - 1)
+    x1 = min(width, int(np.ceil((right - 0.5) * scale_x - 0.5)) + 2)
+    y0 = max(0, int(np.floor((top + 0.5) * scale_y - 0.5)) - 1)
+    y1 = min(height, int(np.ceil((bottom - 0.5) * scale_y - 0.5)) + 2)
+
+    # Same pixel-centre mapping as cv2.resize, shifted to the region's origin
+    transform = np.array([
+        [1 / scale_x, 0, (x0 + 0.5) / scale_x - 0.5 - left],
+        [0, 1 / scale_y, (y0 + 0.5) / scale_y - 0.5 - top],
+    ])
+    return cv2.warpAffine(image[y0:y1, x0:x1], transform, (right - left, bottom - top), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+# Function to encode an image in memory and write it, timing both in 'record'
+def write_image(output_path, image, record):
+    import cv2
+
+    with record.stage('encode'):
+        success, encoded = cv2.imencode(os.path.splitext(output_path)[1], image)
+    if not success:
+        raise IOError(f"could not encode {output_path}")
+    with record.stage('write', encoded.nbytes):
+        encoded.tofile(output_path)
+
+def resize_and_crop_file(image_path, output_path, resize_resolution, crop_area, metrics=None):
+    import cv2
 
-progress_bar.close()
-resize_time = time.time() - start_time
-print(f"Images resized in {resize_time:.2f} seconds.")
-
-progress_bar = tqdm(total=num_images, desc="Cropping Images", unit="image")
-start_time = time.time()
-
-for output_dir in output_dirs:
-    for frame, image_file in enumerate(sorted(os.listdir(output_dir))):
-        if image_file.endswith("." + export_format):
-            image_path = os.path.join(output_dir, image_file)
-            image = cv2.imread(image_path)
-            if image is None:
-                continue  # Skip non-image files
-            print(f"Cropping image {image_file} with shape {image.shape}, crop area {crop_area}")
-            cropped_image = image[crop_area[0]:crop_area[1], crop_area[2]:crop_area[3]]
-            cv2.imwrite(image_path, cropped_image)
+    with track(metrics, os.path.basename(image_path)) as record:
+        with record.stage('read', os.path.getsize(image_path)):
+            image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            return False  # Skip non-image files
+        with record.stage('transform'):
+            cropped_image = resize_and_crop_image(image, resize_resolution, crop_area)
+        write_image(output_path, cropped_image, record)
+        return True
+
+# Function to resize and crop every image once, spread across a thread pool.
+# OpenCV releases the GIL while decoding, resampling and encoding.
+def resize_and_crop_images(selected_dirs, output_dirs, export_format, resize_resolution, crop_area, workers, progress_bar, metrics=None):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for dir_path, output_dir in zip(selected_dirs, output_dirs):
+            for image_file in sorted(os.listdir(dir_path)):
+                if image_file.endswith("." + export_format):
+                    futures.append(executor.submit(resize_and_crop_file, os.path.join(dir_path, image_file), os.path.join(output_dir, image_file), resize_resolution, crop_area, metrics))
+
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                progress_bar.update(1)
+
+# Function to crop one frame straight from the array store. The crop is
+# rendered with the value range stored for the whole frame, like the extracted
+# images, so crops match the image path and don't flicker from frame to frame.
+# Pages of the memory map are read while cropping, so 'read' only covers
+# opening the frame and its range.
+def crop_array_frame(store, channel, key, output_path, resize_resolution, crop_area, gray_scale, colormap='viridis', metrics=None):
+    with track(metrics, f"{channel}/{key}") as record:
+        with record.stage('read'):
+            data = store.read(channel, key)
+            vmin, vmax = store.value_range(channel, key, data)
+        with record.stage('transform'):
+            cropped_data = resize_and_crop_image(data, resize_resolution, crop_area)
+            image = render_image(cropped_data, cmap='gray' if gray_scale else colormap, vmin=vmin, vmax=vmax)
+            if image.ndim == 3:
+                image = image[..., ::-1]  # OpenCV expects BGR
+        write_image(output_path, image, record)
+
+# Function to crop every frame of the selected channels in an array store
+def crop_array_store(store_dir, channels, cropped_images_dir, export_format, resize_resolution, crop_area, gray_scale, workers, colormap='viridis', metrics=None):
+    store = ArrayStore(store_dir)
+    channels = channels or store.channels()
+    order_name = os.path.basename(os.path.dirname(os.path.normpath(store_dir)))
+
+    frames = []
+    for channel in channels:
+        output_dir = os.path.join(cropped_images_dir, order_name, "images", channel)
+        create_directory(output_dir)
+        for key in store.keys(channel):
+            frames.append((channel, key, os.path.join(output_dir, f"image_{channel}_s{key}.{export_format}")))
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+         tqdm(total=len(frames), desc="Cropping Arrays", unit="frame") as progress_bar:
+        futures = [executor.submit(crop_array_frame, store, channel, key, output_path, resize_resolution, crop_area, gray_scale, colormap, metrics) for channel, key, output_path in frames]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
             progress_bar.update(1)
+    print(f"Arrays cropped in {time.time() - start_time:.2f} seconds.")
+
+# Function to resize every image to disk, then re-read and crop it in a second pass
+def resize_then_crop_images(selected_dirs, output_dirs, export_format, resize_resolution, crop_area, num_images, metrics=None):
+    import cv2
+
+    progress_bar = tqdm(total=num_images, desc="Resizing Images", unit="image")
+    start_time = time.time()
+
+    for dir_path, output_dir in zip(selected_dirs, output_dirs):
+        for frame, image_file in enumerate(sorted(os.listdir(dir_path))):
+            if image_file.endswith("." + export_format):
+                image_path = os.path.join(dir_path, image_file)
+                with track(metrics, f"resize/{image_file}") as record:
+                    with record.stage('read', os.path.getsize(image_path)):
+                        image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+                    if image is None:
+                        continue  # Skip non-image files
+                    with record.stage('transform'):
+                        resized_image = cv2.resize(image, resize_resolution)
+                    temp_image_path = os.path.join(output_dir, image_file)
+                    write_image(temp_image_path, resized_image, record)
+                progress_bar.update(1)
+
+    progress_bar.close()
+    resize_time = time.time() - start_time
+    print(f"Images resized in {resize_time:.2f} seconds.")
+
+    progress_bar = tqdm(total=num_images, desc="Cropping Images", unit="image")
+    start_time = time.time()
+
+    for output_dir in output_dirs:
+        for frame, image_file in enumerate(sorted(os.listdir(output_dir))):
+            if image_file.endswith("." + export_format):
+                image_path = os.path.join(output_dir, image_file)
+                with track(metrics, f"crop/{image_file}") as record:
+                    with record.stage('read', os.path.getsize(image_path)):
+                        image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+                    if image is None:
+                        continue  # Skip non-image files
+                    print(f"Cropping image {image_file} with shape {image.shape}, crop area {crop_area}")
+                    with record.stage('transform'):
+                        cropped_image = image[crop_area[0]:crop_area[1], crop_area[2]:crop_area[3]]
+                    write_image(image_path, cropped_image, record)
+                progress_bar.update(1)
+
+    progress_bar.close()
+    crop_time = time.time() - start_time
+    print(f"Images cropped in {crop_time:.2f} seconds.")
+
+# Function to crop and resize every image of the given channel directories,
+# without prompting. Each '<order>/images/<channel>' directory is recreated
+# under 'cropped_images_dir'. Returns the output directories.
+def crop_image_dirs(input_image_dirs, cropped_images_dir, export_format="jpg", resize_resolution=(2400, 2400), crop_area=(50, 450, 900, 1500), single_pass=False, workers=None, metrics=None):
+    resize_resolution = tuple(resize_resolution)
+    crop_area = tuple(crop_area)
+    output_dirs = [create_output_subdirectories(cropped_images_dir, dir_path) for dir_path in input_image_dirs]
+    num_images = sum(1 for dir_path in input_image_dirs for f in os.listdir(dir_path) if f.endswith("." + export_format))
+
+    if single_pass:
+        progress_bar = tqdm(total=num_images, desc="Resizing and Cropping Images", unit="image")
+        start_time = time.time()
+        resize_and_crop_images(input_image_dirs, output_dirs, export_format, resize_resolution, crop_area, workers or os.cpu_count(), progress_bar, metrics)
+        progress_bar.close()
+        print(f"Images resized and cropped in {time.time() - start_time:.2f} seconds.")
+    else:
+        resize_then_crop_images(input_image_dirs, output_dirs, export_format, resize_resolution, crop_area, num_images, metrics)
+
+    return output_dirs
+
+def copy_render_script(cropped_images_dir):
+    render_script_file = "tools/render_animation.py"
+    destination_folder = cropped_images_dir
+    destination_path = os.path.join(destination_folder, render_script_file)
+
+    if not os.path.exists(destination_path):
+        shutil.copy(render_script_file, destination_folder)
+        print(f"File '{render_script_file}' copied to '{destination_path}'.")
+    else:
+        print(f"File '{render_script_file}' already exists in '{destination_path}'. No need to copy.")
+
+def main():
+    args = parse_args()
+
+    export_format = args.export_format
+    resize_resolution = tuple(args.resize_resolution)
+    crop_area = tuple(args.crop_area)
+    cropped_images_dir = os.path.join(get_script_directory(), "..", "cropped_images")
+    create_directory(cropped_images_dir)
+
+    metrics = create_metrics("image_crop", args.metrics)
+
+    if args.array_store:
+        crop_array_store(args.array_store, args.channels, cropped_images_dir, export_format, resize_resolution, crop_area, args.gray_scale, args.workers, args.colormap, metrics)
+        if metrics is not None:
+            metrics.close()
+        copy_render_script(cropped_images_dir)
+        return
+
+    if args.input_image_dirs is None:
+        script_dir = get_script_directory()
+        extracted_data_dir = os.path.join(script_dir, "..", "extracted_data")
+        selected_dirs = select_channels(extracted_data_dir)
+    else:
+        selected_dirs = args.input_image_dirs
 
-progress_bar.close()
-crop_time = time.time() - start_time
-print(f"Images cropped in {crop_time:.2f} seconds.")
+    crop_image_dirs(selected_dirs, cropped_images_dir, export_format, resize_resolution, crop_area, args.single_pass, args.workers, metrics)
 
-render_script_file = "tools/render_animation.py"
-destination_folder = cropped_images_dir
-destination_path = os.path.join(destination_folder, render_script_file)
+    if metrics is not None:
+        metrics.close()
+    copy_render_script(cropped_images_dir)
 
-if not os.path.exists(destination_path):
-    shutil.copy(render_script_file, destination_folder)
-    print(f"File '{render_script_file}' copied to '{destination_path}'.")
-else:
-    print(f"File '{render_script_file}' already exists in '{destination_path}'. No need to copy.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Persistent per-order manifest of every file in a source list, stored as
+# SQLite next to the downloaded files. Each row records the expected size and
+# validator (ETag/Last-Modified) seen on the server and what was last found
+# on disk, so re-runs and "what's missing" checks only need a stat() per file.
+
+MANIFEST_FILENAME = '.manifest.sqlite'
+
+# File states
+MISSING = 'missing'
+PARTIAL = 'partial'
+UNVERIFIED = 'unverified'  # on disk, but the expected size isn't known yet
+COMPLETE = 'complete'
+CORRUPT = 'corrupt'
+
+# Leading bytes of netCDF classic (CDF) and netCDF-4/HDF5 files
+NETCDF_SIGNATURES = (b'CDF\x01', b'CDF\x02', b'CDF\x05', b'\x89HDF\r\n\x1a\n')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    size INTEGER,
+    validator TEXT,
+    local_size INTEGER,
+    local_mtime_ns INTEGER,
+    sha256 TEXT,
+    state TEXT NOT NULL,
+    checked_at REAL
+)
+'''
+
+class Manifest:
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, MANIFEST_FILENAME)
+        os.makedirs(data_dir, exist_ok=True)
+        # Shared across download threads, so every access goes through the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # Function to add the URLs of a source list, keeping rows already known
+    def add_urls(self, urls):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO files (name, url, state) VALUES (?, ?, ?)',
+                [(os.path.basename(url), url, MISSING) for url in urls],
+            )
+
+    def get(self, name):
+        with self.lock:
+            return self.connection.execute('SELECT * FROM files WHERE name = ?', (name,)).fetchone()
+
+    def rows(self, states=None):
+        with self.lock:
+            if states is None:
+                return self.connection.execute('SELECT * FROM files ORDER BY name').fetchall()
+            placeholders = ','.join('?' * len(states))
+            return self.connection.execute(f'SELECT * FROM files WHERE state IN ({placeholders}) ORDER BY name', tuple(states)).fetchall()
+
+    def summary(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT state, COUNT(*) FROM files GROUP BY state').fetchall())
+
+    # Function to record the size and validator reported by the server. A new
+    # expected size makes the next refresh() look at the local file again.
+    def record_remote(self, name, size, validator):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE files SET local_mtime_ns = CASE WHEN size IS ? THEN local_mtime_ns ELSE NULL END, size = ?, validator = ? WHERE name = ?',
+                (size, size, validator, name),
+            )
+
+    # Function to record that a file finished downloading
+    def mark_complete(self, name, size=None, validator=None):
+        path = os.path.join(self.data_dir, name)
+        stat = os.stat(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE files SET size = COALESCE(?, size), validator = COALESCE(?, validator), local_size = ?, local_mtime_ns = ?, sha256 = NULL, state = ?, checked_at = ? WHERE name = ?',
+                (size, validator, stat.st_size, stat.st_mtime_ns, COMPLETE, time.time(), name),
+            )
+
+    def mark(self, name, state):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE files SET state = ?, checked_at = ? WHERE name = ?', (state, time.time(), name))
+
+    # Function to get the state of a file from what's on disk. Only stat()
+    # calls are made; files whose size and mtime haven't changed since the
+    # last check keep their recorded state.
+    def local_state(self, row):
+        path = os.path.join(self.data_dir, row['name'])
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return PARTIAL if os.path.exists(path + '.part') else MISSING, None
+
+        if row['local_size'] == stat.st_size and row['local_mtime_ns'] == stat.st_mtime_ns and row['state'] in (COMPLETE, CORRUPT):
+            return row['state'], stat
+        if row['size'] is None:
+            return UNVERIFIED, stat
+        return (COMPLETE if stat.st_size == row['size'] else CORRUPT), stat
+
+    # Function to bring every row up to date with the files on disk
+    def refresh(self):
+        updates = []
+        for row in self.rows():
+            state, stat = self.local_state(row)
+            local_size = stat.st_size if stat else None
+            local_mtime_ns = stat.st_mtime_ns if stat else None
+            if (state, local_size, local_mtime_ns) != (row['state'], row['local_size'], row['local_mtime_ns']):
+                updates.append((state, local_size, local_mtime_ns, time.time(), row['name']))
+
+        with self.lock, self.connection:
+            self.connection.executemany('UPDATE files SET state = ?, local_size = ?, local_mtime_ns = ?, checked_at = ? WHERE name = ?', updates)
+        return self.summary()
+
+    # Function to check the contents of files on disk: the netCDF/HDF5 header
+    # always, and a SHA-256 checksum when 'checksum' is set. The first
+    # checksum of a file is stored; later runs compare against it.
+    def verify(self, checksum=False):
+        for row in self.rows(states=(COMPLETE, UNVERIFIED)):
+            path = os.path.join(self.data_dir, row['name'])
+            with open(path, 'rb') as f:
+                header = f.read(8)
+            if not header.startswith(NETCDF_SIGNATURES):
+                self.mark(row['name'], CORRUPT)
+                continue
+
+            if checksum:
+                digest = file_sha256(path)
+                if row['sha256'] is not None and row['sha256'] != digest:
+                    self.mark(row['name'], CORRUPT)
+                    continue
+                with self.lock, self.connection:
+                    self.connection.execute('UPDATE files SET sha256 = ? WHERE name = ?', (digest, row['name']))
+        return self.summary()
+
+    # Function to list the URLs that still need to be downloaded
+    def pending_urls(self):
+        return [row['url'] for row in self.rows(states=(MISSING, PARTIAL, CORRUPT, UNVERIFIED))]
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+# Shared instrumentation for the tools. Each file (or frame, or order page)
+# gets a FileMetrics record with the time and bytes of every stage it went
+# through; a Metrics collector aggregates the records of a run and writes
+# them as JSON lines, or as a Prometheus textfile when the path ends in .prom.
+
+STAGES = ('network', 'read', 'transform', 'encode', 'write')
+
+PROMETHEUS_SUFFIX = '.prom'
+
+# Function to get the peak resident set size in bytes, including finished
+# child processes if 'children' is set. Returns None where the resource
+# module isn't available (Windows).
+def get_peak_rss(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# Timings and byte counts of one file
+class FileMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = {}
+        self.bytes = {}
+        self.error = None
+
+    def add(self, stage, seconds, count=0):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        if count:
+            self.bytes[stage] = self.bytes.get(stage, 0) + count
+
+    @contextlib.contextmanager
+    def stage(self, stage, count=0):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time, count)
+
+    # Generator timing how long each item of 'iterable' takes to arrive,
+    # e.g. the chunks of a streamed response
+    def timed(self, iterable, stage='network'):
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start_time)
+                return
+            self.add(stage, time.perf_counter() - start_time, len(item))
+            yield item
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'status': 'error' if self.error else 'ok',
+            'error': self.error,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'peak_rss': get_peak_rss(),
+        }
+
+# Context manager recording one file into 'metrics'. The record is handed
+# out even without a collector, so instrumented code doesn't need to check.
+@contextlib.contextmanager
+def track(metrics, name):
+    record = FileMetrics(name)
+    try:
+        yield record
+    except BaseException as e:
+        record.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if metrics is not None:
+            metrics.add(record)
+
+# Collector for the records of one run of a tool
+class Metrics:
+    def __init__(self, tool, path):
+        self.tool = tool
+        self.path = path
+        self.prometheus = path.endswith(PROMETHEUS_SUFFIX)
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.files = 0
+        self.errors = 0
+        self.seconds = {}
+        self.bytes = {}
+        self.peak_rss = 0
+        self.output = None if self.prometheus else open(path, 'a', encoding='utf-8')
+
+    # Function to add a FileMetrics record, or its as_dict() from a worker process
+    def add(self, record):
+        if isinstance(record, FileMetrics):
+            record = record.as_dict()
+
+        with self.lock:
+            self.files += 1
+            self.errors += record['status'] == 'error'
+            for stage, seconds in record['seconds'].items():
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            for stage, count in record['bytes'].items():
+                self.bytes[stage] = self.bytes.get(stage, 0) + count
+            self.peak_rss = max(self.peak_rss, record['peak_rss'] or 0)
+
+            if self.output is not None:
+                self.output.write(json.dumps(dict(record, type='file', tool=self.tool, time=time.time())) + '\n')
+                self.output.flush()
+
+    def summary(self):
+        return {
+            'type': 'summary',
+            'tool': self.tool,
+            'time': time.time(),
+            'files': self.files,
+            'errors': self.errors,
+            'wall_seconds': time.time() - self.start_time,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'peak_rss': max(self.peak_rss, get_peak_rss(children=True) or 0),
+        }
+
+    # Function to write the run summary and print where the time went
+    def close(self):
+        summary = self.summary()
+        if self.prometheus:
+            write_prometheus_textfile(self.path, summary)
+        else:
+            self.output.write(json.dumps(summary) + '\n')
+            self.output.close()
+
+        total = sum(summary['seconds'].values())
+        if total > 0:
+            breakdown = ', '.join(f"{stage} {seconds:.2f} s ({100 * seconds / total:.0f}%)" for stage, seconds in sorted(summary['seconds'].items(), key=lambda item: -item[1]))
+            print(f"Stage times over {summary['files']} files: {breakdown}")
+        print(f"Metrics written to '{self.path}'.")
+
+# Function to write a run summary in the Prometheus text exposition format,
+# e.g. for the node_exporter textfile collector. The file is replaced
+# atomically so a scrape never sees it half written.
+def write_prometheus_textfile(path, summary):
+    tool = summary['tool']
+    lines = [
+        '# HELP goes_sat_stage_seconds_total Time spent in each processing stage.',
+        '# TYPE goes_sat_stage_seconds_total counter',
+    ]
+    lines += [f'goes_sat_stage_seconds_total{{tool="{tool}",stage="{stage}"}} {seconds:.6f}' for stage, seconds in sorted(summary['seconds'].items())]
+    lines += [
+        '# HELP goes_sat_stage_bytes_total Bytes moved by each processing stage.',
+        '# TYPE goes_sat_stage_bytes_total counter',
+    ]
+    lines += [f'goes_sat_stage_bytes_total{{tool="{tool}",stage="{stage}"}} {count}' for stage, count in sorted(summary['bytes'].items())]
+    lines += [
+        '# HELP goes_sat_files_total Files processed.',
+        '# TYPE goes_sat_files_total counter',
+        f'goes_sat_files_total{{tool="{tool}",status="ok"}} {summary["files"] - summary["errors"]}',
+        f'goes_sat_files_total{{tool="{tool}",status="error"}} {summary["errors"]}',
+        '# HELP goes_sat_run_seconds Wall time of the last run.',
+        '# TYPE goes_sat_run_seconds gauge',
+        f'goes_sat_run_seconds{{tool="{tool}"}} {summary["wall_seconds"]:.6f}',
+        '# HELP goes_sat_peak_rss_bytes Peak resident set size of the last run.',
+        '# TYPE goes_sat_peak_rss_bytes gauge',
+        f'goes_sat_peak_rss_bytes{{tool="{tool}"}} {summary["peak_rss"]}',
+        '# HELP goes_sat_last_run_timestamp_seconds Time the last run finished.',
+        '# TYPE goes_sat_last_run_timestamp_seconds gauge',
+        f'goes_sat_last_run_timestamp_seconds{{tool="{tool}"}} {summary["time"]:.3f}',
+    ]
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+
+# Function to add the --metrics option to a tool's argument parser
+def add_metrics_argument(parser):
+    parser.add_argument('--metrics', help='Write per-file stage timings, bytes and peak memory to this file as JSON lines, or as a Prometheus textfile if it ends in .prom')
+
+# Function to create the collector for a tool, or None without --metrics
+def create_metrics(tool, path):
+    return Metrics(tool, path) if path else None
@@ -0,0 +1,192 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import concurrent.futures
+import cv2
+from tqdm import tqdm
+from .get_data import download_file, get_session, select_source_file
+from .extract_img_data import extract_image, init_worker
+from .image_crop import resize_and_crop_image
+from .goes_files import index_files, group_by_channel
+
+# Marker passed down a queue to tell a stage's workers to stop
+STOP = object()
+
+# Streaming pipeline: every file flows through download -> extract ->
+# crop/resize -> video as soon as the previous stage is done with it.
+# Stages are connected by bounded queues so a fast stage can't run far ahead
+# of a slow one, and each item carries its frame index so the video stage
+# can put frames back in scan order.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Stream a data source list through download, extraction, cropping and animation.')
+    parser.add_argument('input_file_path', nargs='?', default='', help='Path to the input file containing URLs.')
+    parser.add_argument('--channel', help='Channel identifier to process (e.g., C01). Defaults to the first channel in the source list.')
+    parser.add_argument('--export_format', default='jpg', help='Export image format.')
+    parser.add_argument('--gray_scale', action='store_true', help='Convert images to grayscale.')
+    parser.add_argument('--resize_resolution', type=int, nargs=2, default=[2400, 2400], help='Resize resolution (width height).')
+    parser.add_argument('--crop_area', type=int, nargs=4, default=[50, 450, 900, 1500], help='Crop area (top, bottom, left, right).')
+    parser.add_argument('--video_fps', type=int, default=10, help='Frames per second for the output video.')
+    parser.add_argument('--download_workers', type=int, default=8, help='Number of concurrent downloads.')
+    parser.add_argument('--extract_workers', type=int, default=2, help='Number of extraction worker processes.')
+    parser.add_argument('--crop_workers', type=int, default=2, help='Number of crop/resize worker threads.')
+    parser.add_argument('--queue_size', type=int, default=8, help='Maximum number of files waiting between two stages.')
+    return parser.parse_args()
+
+# Function to run 'func' over items from 'in_queue' on 'workers' threads,
+# passing results to 'out_queue'. Once every worker has stopped, STOP is
+# forwarded 'downstream_workers' times so the next stage shuts down too.
+def start_stage(name, func, in_queue, out_queue, workers, downstream_workers):
+    def worker():
+        while True:
+            item = in_queue.get()
+            if item is STOP:
+                break
+            index, value = item
+            try:
+                result = func(value) if value is not None else None
+            except Exception as e:
+                tqdm.write(f"Error in {name} stage for {value}: {e}")
+                result = None
+            out_queue.put((index, result))
+
+    threads = [threading.Thread(target=worker, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def closer():
+        for thread in threads:
+            thread.join()
+        for _ in range(downstream_workers):
+            out_queue.put(STOP)
+
+    threading.Thread(target=closer, name=f'{name}-closer', daemon=True).start()
+
+def main():
+    args = parse_args()
+    if not args.input_file_path:
+        args.input_file_path = select_source_file()
+        if args.input_file_path is None:
+            return
+
+    with open(args.input_file_path, 'r', encoding='utf-8') as input_file:
+        urls = {os.path.basename(line.strip()): line.strip() for line in input_file if line.strip()}
+
+    channel_files = group_by_channel(index_files(urls.keys()))
+    if not channel_files:
+        print("No ABI channel files found in the source list.")
+        exit(1)
+    channel = args.channel or sorted(channel_files)[0]
+    goes_files = channel_files.get(channel, [])
+    if not goes_files:
+        print(f"No files for channel {channel} in the source list.")
+        exit(1)
+
+    # Lay out outputs the same way get_data.py, extract_img_data.py and image_crop.py do
+    order_name = os.path.splitext(os.path.basename(args.input_file_path))[0]
+    data_dir = os.path.join('data', order_name)
+    extracted_dir = os.path.join('extracted_data', order_name, 'images', channel)
+    cropped_dir = os.path.join('cropped_images', order_name, 'images', channel)
+    for directory in (data_dir, extracted_dir, cropped_dir):
+        os.makedirs(directory, exist_ok=True)
+    video_path = os.path.join('cropped_images', order_name, 'images', f'{order_name}_{channel}_animation.mp4')
+
+    resize_resolution = tuple(args.resize_resolution)
+    crop_area = tuple(args.crop_area)
+
+    url_queue = queue.Queue()
+    downloaded_queue = queue.Queue(maxsize=args.queue_size)
+    extracted_queue = queue.Queue(maxsize=args.queue_size)
+    frame_queue = queue.Queue(maxsize=args.queue_size)
+
+    # Frames held by the video stage while it waits for an earlier one are
+    # capped too: a file is only handed to the download stage once fewer than
+    # 'max_pending' files are between download and the video. A stalled early
+    # frame then makes the whole pipeline wait instead of piling up later
+    # frames in memory. The cap never goes below the number of workers, so
+    # every stage can stay busy.
+    max_pending = max(args.queue_size * args.crop_workers, args.download_workers + args.extract_workers + args.crop_workers)
+    frame_slots = threading.Semaphore(max_pending)
+
+    def feed():
+        for index, goes_file in enumerate(goes_files):
+            frame_slots.acquire()
+            url_queue.put((index, urls[goes_file.name]))
+        for _ in range(args.download_workers):
+            url_queue.put(STOP)
+
+    threading.Thread(target=feed, name='feed', daemon=True).start()
+
+    # Stage functions get the previous stage's result for one file. Items that
+    # failed upstream are passed along as None so the video stage knows not to
+    # wait for that frame.
+    def download(url):
+        save_path = os.path.join(data_dir, os.path.basename(url))
+        download_file(url, save_path, get_session())
+        return save_path
+
+    extract_executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.extract_workers, initializer=init_worker)
+
+    def extract(nc_path):
+        original_filename = os.path.splitext(os.path.basename(nc_path))[0]
+        image_path = os.path.join(extracted_dir, f'image_{original_filename}.{args.export_format}')
+        extract_executor.submit(extract_image, nc_path, image_path, args.export_format, args.gray_scale, False).result()
+        return image_path
+
+    def crop(image_path):
+        image = cv2.imread(image_path)
+        if image is None:
+            raise IOError("could not read image")
+        cropped_image = resize_and_crop_image(image, resize_resolution, crop_area)
+        cv2.imwrite(os.path.join(cropped_dir, os.path.basename(image_path)), cropped_image)
+        return cropped_image
+
+    start_time = time.time()
+    start_stage('download', download, url_queue, downloaded_queue, args.download_workers, args.extract_workers)
+    start_stage('extract', extract, downloaded_queue, extracted_queue, args.extract_workers, args.crop_workers)
+    start_stage('crop', crop, extracted_queue, frame_queue, args.crop_workers, 1)
+
+    # Video stage: frames can finish out of order, so hold them until every
+    # earlier frame has been written or has failed.
+    video_writer = None
+    pending = {}
+    next_index = 0
+    frames_written = 0
+    first_frame_time = None
+    stopped = False
+
+    with tqdm(total=len(goes_files), desc=f'Streaming {channel}', unit='file') as progress_bar:
+        try:
+            while not stopped:
+                item = frame_queue.get()
+                if item is STOP:
+                    stopped = True
+                else:
+                    pending[item[0]] = item[1]
+
+                while next_index in pending:
+                    frame = pending.pop(next_index)
+                    if frame is not None:
+                        if video_writer is None:
+                            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                            video_writer = cv2.VideoWriter(video_path, fourcc, args.video_fps, (frame.shape[1], frame.shape[0]))
+                            first_frame_time = time.time() - start_time
+                        video_writer.write(frame)
+                        frames_written += 1
+                    next_index += 1
+                    frame_slots.release()
+                    progress_bar.update(1)
+        finally:
+            if video_writer is not None:
+                video_writer.release()
+            extract_executor.shutdown()
+
+    total_time = time.time() - start_time
+    if first_frame_time is not None:
+        print(f"First frame ready after {first_frame_time:.2f} seconds.")
+    print(f"{frames_written} of {len(goes_files)} frames written to '{video_path}' in {total_time:.2f} seconds.")
+
+if __name__ == "__main__":
+    main()
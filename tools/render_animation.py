@@ -1,116 +1,282 @@
 import os
-import cv2
+import bisect
 import argparse
+import collections
+import concurrent.futures
+from datetime import timedelta
+import numpy as np
 from tqdm import tqdm
+from .array_store import ArrayStore
+from .colormap import render_image
+from .goes_files import parse_scan_start, parse_goes_time
+from .metrics import FileMetrics, add_metrics_argument, create_metrics
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(description='Blend and animate images.')
-parser.add_argument('--input_image_dirs', nargs='*', help='List of input image directories')
-parser.add_argument('--video_fps', type=int, help='Frames per second for the output video')
-parser.add_argument('--export_format', default='jpg', help='Export format for images')
-parser.add_argument('--alpha', type=float, help='Alpha value for image blending')
-args = parser.parse_args()
+def parse_args():
+    parser = argparse.ArgumentParser(description='Blend and animate images.')
+    parser.add_argument('--input_image_dirs', nargs='*', help='List of input image directories')
+    parser.add_argument('--video_fps', type=int, help='Frames per second for the output video')
+    parser.add_argument('--export_format', default='jpg', help='Export format for images')
+    parser.add_argument('--alpha', type=float, help='Alpha value for image blending')
+    parser.add_argument('--array_store', help='Render raw arrays from this array store (e.g. extracted_data/<order>/arrays) instead of images')
+    parser.add_argument('--channels', nargs='*', help='Channels to render from the array store (default: all)')
+    parser.add_argument('--time_tolerance', type=float, default=60, help='Maximum difference in seconds between scan start times of frames blended together (default 60)')
+    parser.add_argument('--prefetch', type=int, default=8, help='Number of frames decoded ahead of the encoder (default 8)')
+    parser.add_argument('--decode_workers', type=int, default=4, help='Number of threads decoding frames (default 4)')
+    add_metrics_argument(parser)
+    return parser.parse_args()
 
-# Prompt for input image directory if not provided
-if args.input_image_dirs is None:
+# Function to prompt for input image directories
+def select_input_dirs():
     selected_dirs = []
     available_dirs = os.listdir('cropped_images')
 
     valid_directory = False
     valid_channel = False
-    
+
     while valid_directory is False or valid_channel is False:
         print("Available input image directories:")
         for i, dir_name in enumerate(available_dirs):
             print(f"{i + 1}. {dir_name}")
-        
+
         selected_dir_index = int(input("Select an input image directory (0 to finish): ")) - 1
-        
+
         if selected_dir_index == -1:
             break
         else:
             valid_directory = True
-        
+
         selected_dir = available_dirs[selected_dir_index]
-        
+
         channel_dirs = os.listdir(f'cropped_images/{selected_dir}/images')
         print("Available channel directories:")
         for i, channel_name in enumerate(channel_dirs):
             print(f"{i + 1}. {channel_name}")
-        
+
         selected_channel_indices = [int(idx) - 1 for idx in input("Select channel indices (comma-separated): ").split(',')]
-        
+
         if -1 in selected_channel_indices:
             break
         else:
             valid_channel = True
-        
+
         selected_dirs.extend([f'cropped_images/{selected_dir}/images/{channel_dirs[i]}' for i in selected_channel_indices])
-    
-    args.input_image_dirs = selected_dirs
 
-# Prompt for video FPS if not provided
-if args.video_fps is None:
-    args.video_fps = int(input("Enter video FPS (default 10): ") or 10)
+    return selected_dirs
+
+# Function to pair up frames of different channels by scan start time.
+# 'channel_frames' holds one sorted list of (scan start, item) per channel;
+# the first channel is the reference. A reference frame is kept only if
+# every other channel has a frame within 'tolerance'.
+def align_frames(channel_frames, tolerance):
+    reference_frames = channel_frames[0]
+    other_channels = []
+    for frames in channel_frames[1:]:
+        other_channels.append(([time for time, _ in frames], [item for _, item in frames]))
 
-# Prompt for alpha value if not provided
-if args.alpha is None:
-    args.alpha = float(input("Enter alpha value (default 0.25): ") or 0.25)
+    aligned = []
+    for time, item in reference_frames:
+        frame = [item]
+        for times, items in other_channels:
+            # Nearest neighbour of 'time' in this channel
+            i = bisect.bisect_left(times, time)
+            candidates = [j for j in (i - 1, i) if 0 <= j < len(times)]
+            if not candidates:
+                break
+            j = min(candidates, key=lambda j: abs(times[j] - time))
+            if abs(times[j] - time) > tolerance:
+                break
+            frame.append(items[j])
+        else:
+            aligned.append(frame)
+    return aligned
+
+# Function to build the list of frames for image directories. Channels are
+# aligned by scan start time when every filename carries one, otherwise
+# they're paired by sorted position.
+def list_image_frames(input_image_dirs, export_format, tolerance):
+    channel_files = []
+    for dir_path in input_image_dirs:
+        image_files = sorted(f for f in os.listdir(dir_path) if f.endswith('.' + export_format))
+        channel_files.append([os.path.join(dir_path, f) for f in image_files])
+
+    channel_frames = [[(parse_scan_start(path), path) for path in paths] for paths in channel_files]
+    if all(time is not None for frames in channel_frames for time, _ in frames):
+        return align_frames([sorted(frames) for frames in channel_frames], tolerance)
+
+    print("Not every image name has a scan start time, pairing frames by sorted position.")
+    return [list(paths) for paths in zip(*channel_files)]
+
+# Decode one frame of every channel and bring them to the video size. Runs
+# on the prefetch threads; OpenCV releases the GIL while decoding/resizing.
+# Returns the images and the frame's metrics record.
+def load_frame(load_image, sources, size):
+    import cv2
 
-# Ensure there is at least one input directory provided
-if not args.input_image_dirs:
-    print("No input image directories provided.")
-    exit(1)
+    record = FileMetrics(os.path.basename(str(sources[0])))
+    images = []
+    for channel_index, source in enumerate(sources):
+        with record.stage('read'):
+            image = load_image(channel_index, source)
+        if image is None:
+            raise IOError(f"could not read {source}")
+        record.add('read', 0.0, image.nbytes)
+        with record.stage('transform'):
+            if image.dtype == np.uint16:
+                image = (image >> 8).astype(np.uint8)
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            if (image.shape[1], image.shape[0]) != size:
+                image = cv2.resize(image, size)
+        images.append(image)
+    return images, record
 
-# Create output video filename based on input directories
-output_channel_names = '_'.join([os.path.basename(dir_path) for dir_path in args.input_image_dirs])
-output_video_filename = f'{selected_dir}_{output_channel_names}_animation.mp4'
+# Function to run 'func' over 'items' on background threads, keeping up to
+# 'prefetch' items in flight ahead of the consumer. Yields the futures in order.
+def prefetch_map(func, items, prefetch, workers):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        item_iter = iter(items)
 
-# Create a list to store image filenames in alphabetical order for each channel
-image_files_lists = []
+        for item in item_iter:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= prefetch:
+                break
 
-# Iterate through input image directories and store sorted image filenames
-for dir_path in args.input_image_dirs:
-    image_files = [f for f in os.listdir(dir_path) if f.endswith('.' + args.export_format)]
-    sorted_image_files = sorted(image_files)
-    image_files_lists.append(sorted_image_files)
+        while pending:
+            future = pending.popleft()
+            next_item = next(item_iter, None)
+            if next_item is not None:
+                pending.append(executor.submit(func, next_item))
+            yield future
 
-# Determine the number of frames based on the shortest image list
-num_frames = min(len(image_files) for image_files in image_files_lists)
+# Function to decode frames on background threads, keeping up to 'prefetch'
+# frames in flight ahead of the consumer. Yields the frames in order.
+def prefetch_frames(load_image, frames, size, prefetch, workers):
+    return prefetch_map(lambda sources: load_frame(load_image, sources, size), frames, prefetch, workers)
 
-# Get the dimensions of the first image to determine video resolution
-first_image_path = os.path.join(args.input_image_dirs[0], image_files_lists[0][0])
-first_image = cv2.imread(first_image_path)
-resize_resolution = (first_image.shape[1], first_image.shape[0])
+# Function to blend a BGRA image over 'blended_image' in place. Each pixel
+# is weighted by 'alpha' times its own opacity, so transparent pixels (e.g.
+# empty GLM grid cells) leave the frame below unchanged.
+def blend_transparent(blended_image, image, alpha):
+    weight = image[..., 3:].astype(np.float32) * (alpha / 255)
+    blended = blended_image + (image[..., :3] - blended_image.astype(np.float32)) * weight
+    np.copyto(blended_image, blended + 0.5, casting='unsafe')
 
-# Create VideoWriter object
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-video_writer = cv2.VideoWriter('cropped_images/' + selected_dir + "/images/" + output_video_filename, fourcc, args.video_fps, resize_resolution)
+# Function to render the aligned frames to a video, blending channels into
+# a buffer that is allocated once and reused for every frame
+def render_video(output_video_path, load_image, frames, video_fps, alpha, prefetch=8, decode_workers=4, metrics=None):
+    # OpenCV is imported on first use so importing this module stays cheap
+    import cv2
+
+    first_image = load_image(0, frames[0][0])
+    size = (first_image.shape[1], first_image.shape[0])
+    blended_image = np.empty((size[1], size[0], 3), dtype=np.uint8)
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video_writer = cv2.VideoWriter(output_video_path, fourcc, video_fps, size)
 
-# Iterate through frames and blend images from different channels
-for frame in tqdm(range(num_frames), desc='Creating Video', unit='frame'):
     try:
-        blended_image = None
-        
-        for image_files in image_files_lists:
-            image_file = image_files[frame]
-            image_path = os.path.join(args.input_image_dirs[image_files_lists.index(image_files)], image_file)
-            image = cv2.imread(image_path)
-            
-            # Resize the image to match the dimensions of the first image
-            resized_image = cv2.resize(image, resize_resolution)
-            
-            if blended_image is None:
-                blended_image = resized_image
-            else:
-                blended_image = cv2.addWeighted(blended_image, 1 - args.alpha, resized_image, args.alpha, 0)
-        
-        if blended_image is not None:
-            video_writer.write(blended_image)
-    except Exception as e:
-        print(f"Error processing frame {frame}: {e}")
-
-# Release the video writer
-video_writer.release()
-
-print(f'Video "cropped_images/{selected_dir}/images/{output_video_filename}" created successfully.')
+        for frame, future in enumerate(tqdm(prefetch_frames(load_image, frames, size, prefetch, decode_workers), total=len(frames), desc='Creating Video', unit='frame')):
+            try:
+                images, record = future.result()
+                with record.stage('transform'):
+                    np.copyto(blended_image, images[0][..., :3])
+                    for image in images[1:]:
+                        if image.shape[2] == 4:
+                            blend_transparent(blended_image, image, alpha)
+                        else:
+                            cv2.addWeighted(blended_image, 1 - alpha, image, alpha, 0, dst=blended_image)
+                # The video writer encodes and writes in one call
+                with record.stage('encode', blended_image.nbytes):
+                    video_writer.write(blended_image)
+                if metrics is not None:
+                    metrics.add(record)
+            except Exception as e:
+                print(f"Error processing frame {frame}: {e}")
+    finally:
+        video_writer.release()
+
+# Function to load a frame image from disk, keeping the alpha channel of
+# transparent overlays
+def read_image_file(channel_index, image_path):
+    import cv2
+    return cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+
+# Function to render an animation of image directories, without prompting.
+# Frames of the channels are aligned by scan start time and blended with
+# 'alpha'. The video is written next to the channel directories unless
+# 'output_video_path' is given. Returns the video path.
+def render_image_dirs(input_image_dirs, video_fps=10, alpha=0.25, export_format='jpg', time_tolerance=60, prefetch=8, decode_workers=4, output_video_path=None, metrics=None):
+    if not input_image_dirs:
+        raise ValueError("no input image directories given")
+
+    frames = list_image_frames(input_image_dirs, export_format, timedelta(seconds=time_tolerance))
+    if not frames:
+        raise ValueError("no frames to render")
+
+    # Create output video filename based on input directories
+    if output_video_path is None:
+        output_channel_names = '_'.join([os.path.basename(os.path.normpath(dir_path)) for dir_path in input_image_dirs])
+        output_dir = os.path.dirname(os.path.normpath(input_image_dirs[0]))
+        output_video_filename = f'{os.path.basename(os.path.dirname(output_dir))}_{output_channel_names}_animation.mp4'
+        output_video_path = os.path.join(output_dir, output_video_filename)
+
+    render_video(output_video_path, read_image_file, frames, video_fps, alpha, prefetch, decode_workers, metrics)
+    return output_video_path
+
+# Function to render an animation straight from the memory-mapped array
+# store, without prompting. The video is written next to the store unless
+# 'output_video_path' is given. Returns the video path.
+def render_array_store(store_dir, channels=None, video_fps=10, alpha=0.25, time_tolerance=60, prefetch=8, decode_workers=4, output_video_path=None, metrics=None):
+    store = ArrayStore(store_dir)
+    channels = channels or store.channels()
+    if not channels:
+        raise ValueError(f"no channels found in array store '{store_dir}'")
+
+    frames = align_frames([[(parse_goes_time(key), key) for key in store.keys(channel)] for channel in channels], timedelta(seconds=time_tolerance))
+    if not frames:
+        raise ValueError("no frames to render")
+
+    if output_video_path is None:
+        output_dir = os.path.dirname(os.path.normpath(store_dir))
+        output_video_path = os.path.join(output_dir, f"{os.path.basename(output_dir)}_{'_'.join(channels)}_animation.mp4")
+
+    def load_image(channel_index, frame_key):
+        return render_image(store.read(channels[channel_index], frame_key), cmap='gray')
+
+    render_video(output_video_path, load_image, frames, video_fps, alpha, prefetch, decode_workers, metrics)
+    return output_video_path
+
+def main():
+    args = parse_args()
+
+    # Prompt for input image directory if not provided
+    if args.input_image_dirs is None and args.array_store is None:
+        args.input_image_dirs = select_input_dirs()
+
+    # Prompt for video FPS if not provided
+    if args.video_fps is None:
+        args.video_fps = int(input("Enter video FPS (default 10): ") or 10)
+
+    # Prompt for alpha value if not provided
+    if args.alpha is None:
+        args.alpha = float(input("Enter alpha value (default 0.25): ") or 0.25)
+
+    metrics = create_metrics('render_animation', args.metrics)
+    try:
+        if args.array_store:
+            # Frames come straight from the memory-mapped array store
+            output_video_path = render_array_store(args.array_store, args.channels, args.video_fps, args.alpha, args.time_tolerance, args.prefetch, args.decode_workers, metrics=metrics)
+        else:
+            output_video_path = render_image_dirs(args.input_image_dirs, args.video_fps, args.alpha, args.export_format, args.time_tolerance, args.prefetch, args.decode_workers, metrics=metrics)
+    except ValueError as e:
+        print(f"Nothing rendered: {e}.")
+        exit(1)
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+    print(f'Video "{output_video_path}" created successfully.')
+
+if __name__ == "__main__":
+    main()
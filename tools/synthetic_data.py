@@ -0,0 +1,163 @@
+import os
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+from netCDF4 import Dataset
+from .goes_files import format_goes_time
+
+# Synthetic GOES-R files for benchmarks. The files follow the layout of the
+# real products closely enough for every tool in this folder to read them:
+#  - OR_ABI-L2-CMIPF: packed int16 CMI on the fixed grid with x/y scan angles,
+#    the goes_imager_projection variable, off-disk pixels as _FillValue and
+#    zlib compression in 226x226 chunks like the archive files.
+#  - OR_GLM-L2-LCFA: flash/group/event lat, lon and packed energy arrays.
+
+# Full disk grid size per channel (0.5 km, 1 km or 2 km)
+FULL_DISK_SIZES = {'C01': 10848, 'C02': 21696, 'C03': 10848, 'C05': 10848}
+FULL_DISK_SIZE_2KM = 5424
+
+# Scan angle of the outermost full disk pixel centre (radians)
+FULL_DISK_EXTENT = 0.151844
+
+# Approximate radius of the Earth disk in scan angle space (radians)
+EARTH_DISK_RADIUS = 0.1512
+
+# Seconds between full disk scans in scan mode 6, and the scan duration
+SCAN_INTERVAL = 600
+SCAN_DURATION = 560
+
+# Seconds covered by one GLM LCFA file
+GLM_FILE_DURATION = 20
+
+# Function to get the full disk grid size of a channel, shrunk by 'scale'
+def get_grid_size(channel, scale=1.0):
+    return max(16, int(round(FULL_DISK_SIZES.get(channel, FULL_DISK_SIZE_2KM) * scale)))
+
+# Function to build a GOES-R filename from its parts
+def make_filename(product, satellite, start, duration):
+    end = start + timedelta(seconds=duration)
+    created = end + timedelta(seconds=7)
+    return f'OR_{product}_{satellite}_s{format_goes_time(start)}_e{format_goes_time(end)}_c{format_goes_time(created)}.nc'
+
+# Function to generate a smooth cloud-like field in [0, 1], in strips of
+# rows so full size 0.5 km grids never have to be held in memory. Coarse
+# noise is interpolated up so the data compresses about as well as imagery.
+def field_strips(size, rng, frame=0, strip_rows=1024):
+    coarse_size = max(4, size // 64)
+    coarse = rng.random((coarse_size + 1, coarse_size + 1)).astype(np.float32)
+    # Drift the field a little from frame to frame
+    index = (np.linspace(0, coarse_size, size, dtype=np.float32) + 0.05 * frame) % coarse_size
+    i0 = index.astype(np.int64)
+    t = index - i0
+    rows = coarse[i0] * (1 - t)[:, None] + coarse[i0 + 1] * t[:, None]
+
+    for top in range(0, size, strip_rows):
+        bottom = min(size, top + strip_rows)
+        strip = rows[top:bottom, i0] * (1 - t) + rows[top:bottom, i0 + 1] * t
+        strip += rng.normal(0, 0.02, strip.shape).astype(np.float32)
+        yield top, bottom, np.clip(strip, 0, 1)
+
+# Function to write one synthetic CMIPF file
+def write_cmi_file(path, channel, size, rng, frame=0, lon_0=-75.0):
+    reflective = int(channel[1:]) <= 6
+    with Dataset(path, 'w') as dataset:
+        dataset.createDimension('y', size)
+        dataset.createDimension('x', size)
+
+        scale = 2 * FULL_DISK_EXTENT / (size - 1)
+        x = dataset.createVariable('x', 'i2', ('x',))
+        x.scale_factor = scale
+        x.add_offset = -FULL_DISK_EXTENT
+        x[:] = np.arange(size) * scale - FULL_DISK_EXTENT
+        y = dataset.createVariable('y', 'i2', ('y',))
+        y.scale_factor = -scale
+        y.add_offset = FULL_DISK_EXTENT
+        y[:] = FULL_DISK_EXTENT - np.arange(size) * scale
+
+        projection = dataset.createVariable('goes_imager_projection', 'i4')
+        projection.grid_mapping_name = 'geostationary'
+        projection.perspective_point_height = 35786023.0
+        projection.semi_major_axis = 6378137.0
+        projection.semi_minor_axis = 6356752.31414
+        projection.longitude_of_projection_origin = lon_0
+        projection.sweep_angle_axis = 'x'
+
+        # 12-bit reflectance factor or 14-bit brightness temperature
+        cmi = dataset.createVariable('CMI', 'i2', ('y', 'x'), fill_value=-1, zlib=True, complevel=1, chunksizes=(min(226, size), min(226, size)))
+        cmi.grid_mapping = 'goes_imager_projection'
+        if reflective:
+            cmi.scale_factor = np.float32(1 / 4095)
+            cmi.add_offset = np.float32(0.0)
+            cmi.units = '1'
+        else:
+            cmi.scale_factor = np.float32(0.01)
+            cmi.add_offset = np.float32(180.0)
+            cmi.units = 'K'
+
+        angles = np.arange(size, dtype=np.float32) * scale - FULL_DISK_EXTENT
+        for top, bottom, strip in field_strips(size, rng, frame):
+            values = strip if reflective else 320.0 - 120.0 * strip
+            off_disk = angles[None, :] ** 2 + angles[top:bottom, None] ** 2 > EARTH_DISK_RADIUS ** 2
+            cmi[top:bottom, :] = np.ma.masked_array(values, mask=off_disk)
+
+# Function to write one synthetic LCFA file with points around 'centre'
+def write_glm_file(path, rng, flashes=200, centre=(30.0, -90.0), spread=5.0, lon_0=-75.0):
+    counts = {'flash': flashes, 'group': flashes * 4, 'event': flashes * 16}
+    with Dataset(path, 'w') as dataset:
+        for kind, count in counts.items():
+            dimension = f'number_of_{kind}s'
+            dataset.createDimension(dimension, count)
+
+            lat = dataset.createVariable(f'{kind}_lat', 'f4', (dimension,))
+            lat[:] = rng.normal(centre[0], spread, count)
+            lon = dataset.createVariable(f'{kind}_lon', 'f4', (dimension,))
+            lon[:] = rng.normal(centre[1], spread, count)
+
+            energy = dataset.createVariable(f'{kind}_energy', 'i2', (dimension,), fill_value=-1)
+            energy.scale_factor = np.float32(1.52597e-15)
+            energy.add_offset = np.float32(2.8515e-16)
+            energy.units = 'J'
+            energy[:] = rng.gamma(2.0, 2e-14, count).clip(0, 4e-11)
+
+        subpoint = dataset.createVariable('nominal_satellite_subpoint_lon', 'f4')
+        subpoint[:] = lon_0
+
+# Function to generate a folder of ABI and GLM files covering the same period.
+# Returns the list of file paths written.
+def generate_dataset(output_dir, channels=('C01', 'C02', 'C13'), frames=6, glm_files=30, scale=0.25, satellite='G16', start=datetime(2023, 6, 6, 7, 0, 21, 400000), seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+
+    for frame in range(frames):
+        scan_start = start + timedelta(seconds=SCAN_INTERVAL * frame)
+        for channel in channels:
+            path = os.path.join(output_dir, make_filename(f'ABI-L2-CMIPF-M6{channel}', satellite, scan_start, SCAN_DURATION))
+            write_cmi_file(path, channel, get_grid_size(channel, scale), rng, frame)
+            paths.append(path)
+
+    for index in range(glm_files):
+        file_start = start + timedelta(seconds=GLM_FILE_DURATION * index)
+        path = os.path.join(output_dir, make_filename('GLM-L2-LCFA', satellite, file_start, GLM_FILE_DURATION))
+        write_glm_file(path, rng)
+        paths.append(path)
+
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic GOES-R ABI (CMIPF) and GLM (LCFA) netCDF files.')
+    parser.add_argument('output_dir', help='Folder to write the files to (e.g. data/synthetic)')
+    parser.add_argument('--channels', nargs='*', default=['C01', 'C02', 'C13'], help='ABI channels to generate (default C01 C02 C13)')
+    parser.add_argument('--frames', type=int, default=6, help='Number of full disk scans per channel, 10 minutes apart (default 6)')
+    parser.add_argument('--glm_files', type=int, default=30, help='Number of 20 second GLM files (default 30)')
+    parser.add_argument('--scale', type=float, default=0.25, help='Grid size relative to the real full disk, 1.0 for 5424/10848/21696 pixels (default 0.25)')
+    parser.add_argument('--satellite', default='G16', help='Satellite in the filenames (default G16)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+    args = parser.parse_args()
+
+    paths = generate_dataset(args.output_dir, args.channels, args.frames, args.glm_files, args.scale, args.satellite, seed=args.seed)
+    total_size = sum(os.path.getsize(path) for path in paths)
+    print(f"{len(paths)} files ({total_size / (1024 * 1024):.2f} MB) written to '{args.output_dir}'.")
+
+if __name__ == "__main__":
+    main()
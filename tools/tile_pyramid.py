@@ -0,0 +1,252 @@
+import os
+import json
+import shutil
+import math
+import argparse
+import numpy as np
+from .colormap import ALPHA_FORMATS, render_valid, quantize
+from .metrics import FileMetrics
+from .array_store import store_key
+
+# Multi-resolution XYZ tile pyramids of extracted frames, laid out as
+# <frame dir>/<z>/<x>/<y>.<format> with 256x256 tiles. The highest zoom level
+# is the frame at full resolution; each level below it is downsampled 2x2 by
+# averaging the valid pixels, down to a level that fits in a single tile.
+# Viewers and croppers can then read just the tiles a region needs at the
+# zoom they need. Tiles with no valid pixels (e.g. space around the full
+# disk) aren't written. A tiles.json file next to the levels describes the
+# pyramid and is written last, so its presence means the pyramid is complete.
+
+TILE_SIZE = 256
+METADATA_FILENAME = 'tiles.json'
+
+# Function to get the zoom level holding the full resolution frame
+def get_max_zoom(width, height):
+    return max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE)))
+
+# Function to downsample an array 2x2 by averaging its valid (non-NaN)
+# pixels. Odd rows or columns are averaged on their own.
+def downsample(data):
+    height, width = data.shape
+    if height % 2 or width % 2:
+        padded = np.full((height + height % 2, width + width % 2), np.nan, dtype=np.float32)
+        padded[:height, :width] = data
+        data = padded
+
+    blocks = data.reshape(data.shape[0] // 2, 2, data.shape[1] // 2, 2)
+    valid = ~np.isnan(blocks)
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float32)
+    count = valid.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count  # 0 / 0 leaves NaN where no pixel was valid
+
+# Writer building a pyramid from the rows of a frame, top to bottom. Rows can
+# come all at once or in strips; each level only holds the rows of its
+# current band of tiles, so strips keep the memory bounded.
+class TilePyramidWriter:
+    def __init__(self, frame_dir, width, height, vmin, vmax, export_format='png', cmap='viridis', png16=False, record=None):
+        self.frame_dir = frame_dir
+        self.width = width
+        self.height = height
+        self.export_format = export_format.lower()
+        self.png16 = png16
+        self.record = record if record is not None else FileMetrics(frame_dir)
+        self.metadata = {
+            'width': width,
+            'height': height,
+            'tile_size': TILE_SIZE,
+            'max_zoom': get_max_zoom(width, height),
+            'format': self.export_format,
+            'vmin': vmin,
+            'vmax': vmax,
+            'cmap': 'gray' if png16 else cmap,
+            'png16': png16,
+        }
+        self.alpha = not png16 and self.export_format in ALPHA_FORMATS
+
+        # Clear an earlier pyramid of the frame so no stale tiles are left
+        metadata_path = os.path.join(frame_dir, METADATA_FILENAME)
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        for zoom in range(self.metadata['max_zoom'] + 1):
+            shutil.rmtree(os.path.join(frame_dir, str(zoom)), ignore_errors=True)
+        os.makedirs(frame_dir, exist_ok=True)
+
+        self.levels = [PyramidLevel(self, zoom) for zoom in range(self.metadata['max_zoom'], -1, -1)]
+
+    # Function to add the next rows of the frame as float32 with NaN for
+    # masked pixels
+    def add_rows(self, rows):
+        self.levels[0].add_rows(rows)
+
+    def close(self):
+        self.levels[0].close()
+        with open(os.path.join(self.frame_dir, METADATA_FILENAME), 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+    def render_tile(self, data):
+        valid = ~np.isnan(data)
+        if self.png16:
+            return quantize(data, valid, self.metadata['vmin'], self.metadata['vmax'], levels=65536, dtype=np.uint16)
+        return render_valid(data, valid, self.metadata['cmap'], self.metadata['vmin'], self.metadata['vmax'], self.alpha)
+
+    def write_tile(self, zoom, x, y, data):
+        from PIL import Image
+
+        with self.record.stage('transform'):
+            image = Image.fromarray(self.render_tile(data))
+        tile_dir = os.path.join(self.frame_dir, str(zoom), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        path = os.path.join(tile_dir, f'{y}.{self.export_format}')
+        with self.record.stage('encode'):
+            image.save(path, format='jpeg' if self.export_format == 'jpg' else self.export_format)
+        self.record.add('write', 0.0, os.path.getsize(path))
+
+class PyramidLevel:
+    def __init__(self, writer, zoom):
+        self.writer = writer
+        self.zoom = zoom
+        self.pending = None
+        self.tile_row = 0
+
+    def add_rows(self, rows):
+        if self.pending is not None:
+            rows = np.concatenate((self.pending, rows))
+            self.pending = None
+
+        full_rows = len(rows) - len(rows) % TILE_SIZE
+        for top in range(0, full_rows, TILE_SIZE):
+            self.write_band(rows[top:top + TILE_SIZE])
+        if full_rows < len(rows):
+            self.pending = rows[full_rows:].copy()
+
+    def close(self):
+        if self.pending is not None:
+            self.write_band(self.pending)
+            self.pending = None
+        if self.zoom > 0:
+            self.get_next_level().close()
+
+    def get_next_level(self):
+        return self.writer.levels[self.writer.metadata['max_zoom'] - self.zoom + 1]
+
+    # Function to write one row of tiles, padding partial tiles at the right
+    # and bottom edges with masked pixels, and pass the band down a level
+    def write_band(self, band):
+        width = band.shape[1]
+        for x, left in enumerate(range(0, width, TILE_SIZE)):
+            tile = band[:, left:left + TILE_SIZE]
+            if np.isnan(tile).all():
+                continue
+            if tile.shape != (TILE_SIZE, TILE_SIZE):
+                padded = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+                padded[:tile.shape[0], :tile.shape[1]] = tile
+                tile = padded
+            self.writer.write_tile(self.zoom, x, self.tile_row, tile)
+        self.tile_row += 1
+
+        if self.zoom > 0:
+            with self.writer.record.stage('transform'):
+                downsampled = downsample(band)
+            self.get_next_level().add_rows(downsampled)
+
+# Function to write the whole pyramid of a frame held in memory. Masked
+# pixels are taken from the mask or NaN; the value range defaults to the
+# frame's own, like the flat images.
+def write_tile_pyramid(frame_dir, data, export_format='png', cmap='viridis', png16=False, vmin=None, vmax=None, record=None):
+    rows = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+    if vmin is None or vmax is None:
+        valid = ~np.isnan(rows)
+        data_min, data_max = (float(rows[valid].min()), float(rows[valid].max())) if valid.any() else (0.0, 0.0)
+        vmin = data_min if vmin is None else vmin
+        vmax = data_max if vmax is None else vmax
+
+    writer = TilePyramidWriter(frame_dir, rows.shape[1], rows.shape[0], vmin, vmax, export_format, cmap, png16, record)
+    writer.add_rows(rows)
+    writer.close()
+
+# Function to get the pyramid folder of a netCDF file under 'tiles_dir',
+# <tiles_dir>/<channel>/<scan start>
+def get_frame_dir(tiles_dir, nc_path):
+    return os.path.join(tiles_dir, *store_key(nc_path))
+
+def read_metadata(frame_dir):
+    with open(os.path.join(frame_dir, METADATA_FILENAME)) as f:
+        return json.load(f)
+
+# Function to pick the lowest zoom level that still shows a region of
+# 'region_width' full resolution pixels at least 'output_width' pixels wide
+def get_zoom_for_width(metadata, region_width, output_width):
+    zoom = metadata['max_zoom']
+    while zoom > 0 and region_width / 2 ** (metadata['max_zoom'] - zoom + 1) >= output_width:
+        zoom -= 1
+    return zoom
+
+# Function to read a region of a frame from its tiles. The bounds (top,
+# bottom, left, right) are in full resolution pixels; the region is returned
+# at 'zoom' (default: full resolution), so it is 2^(max zoom - zoom) times
+# smaller. Only the tiles overlapping the region are decoded. Tiles that
+# weren't written are filled with 0, or 255 without alpha, as masked pixels
+# are in the flat images.
+def read_region(frame_dir, top, bottom, left, right, zoom=None):
+    from PIL import Image
+
+    metadata = read_metadata(frame_dir)
+    if zoom is None:
+        zoom = metadata['max_zoom']
+    if not 0 <= zoom <= metadata['max_zoom']:
+        raise ValueError(f"zoom {zoom} is outside 0..{metadata['max_zoom']}")
+
+    scale = 2 ** (metadata['max_zoom'] - zoom)
+    top, left = max(0, top) // scale, max(0, left) // scale
+    bottom = math.ceil(min(bottom, metadata['height']) / scale)
+    right = math.ceil(min(right, metadata['width']) / scale)
+    if bottom <= top or right <= left:
+        raise ValueError("region is empty")
+
+    if metadata['png16']:
+        mode, shape, dtype, fill = 'I;16', (), np.uint16, 0
+    else:
+        alpha = metadata['format'] in ALPHA_FORMATS
+        mode = ('L' if metadata['cmap'] in ('gray', 'grey') else 'RGB') + ('A' if alpha else '')
+        shape, dtype, fill = ((len(mode),) if len(mode) > 1 else ()), np.uint8, 0 if alpha else 255
+
+    tiles = {}
+    for y in range(top // TILE_SIZE, (bottom - 1) // TILE_SIZE + 1):
+        for x in range(left // TILE_SIZE, (right - 1) // TILE_SIZE + 1):
+            path = os.path.join(frame_dir, str(zoom), str(x), f"{y}.{metadata['format']}")
+            if os.path.exists(path):
+                with Image.open(path) as image:
+                    # Some encoders drop an alpha channel that is fully opaque
+                    tiles[x, y] = np.asarray(image if image.mode == mode else image.convert(mode))
+
+    region = np.full((bottom - top, right - left) + shape, fill, dtype=dtype)
+    for (x, y), tile in tiles.items():
+        # Overlap of the tile with the region, in level pixels
+        tile_top, tile_left = y * TILE_SIZE, x * TILE_SIZE
+        y0, y1 = max(top, tile_top), min(bottom, tile_top + TILE_SIZE)
+        x0, x1 = max(left, tile_left), min(right, tile_left + TILE_SIZE)
+        region[y0 - top:y1 - top, x0 - left:x1 - left] = tile[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left]
+    return region
+
+def main():
+    parser = argparse.ArgumentParser(description='Read a region of a frame from its tile pyramid and save it as an image.')
+    parser.add_argument('frame_dir', help='Tile pyramid of a frame (e.g. extracted_data/<order>/tiles/<channel>/<scan start>)')
+    parser.add_argument('output_path', help='Image file to write (e.g. region.png)')
+    parser.add_argument('--region', type=int, nargs=4, metavar=('TOP', 'BOTTOM', 'LEFT', 'RIGHT'), help='Region in full resolution pixels (default: the whole frame)')
+    zoom_group = parser.add_mutually_exclusive_group()
+    zoom_group.add_argument('--zoom', type=int, help='Zoom level to read (default: full resolution)')
+    zoom_group.add_argument('--width', type=int, help='Read the lowest zoom level giving at least this many pixels across the region')
+    args = parser.parse_args()
+
+    from PIL import Image
+
+    metadata = read_metadata(args.frame_dir)
+    top, bottom, left, right = args.region or (0, metadata['height'], 0, metadata['width'])
+    zoom = get_zoom_for_width(metadata, right - left, args.width) if args.width else args.zoom
+    region = read_region(args.frame_dir, top, bottom, left, right, zoom)
+    Image.fromarray(region).save(args.output_path)
+    print(f"Region {region.shape[1]}x{region.shape[0]} at zoom {metadata['max_zoom'] if zoom is None else zoom} saved to '{args.output_path}'.")
+
+if __name__ == "__main__":
+    main()